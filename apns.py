@@ -25,20 +25,43 @@
 
 from binascii import a2b_hex, b2a_hex
 from datetime import datetime
-from socket import socket, timeout, AF_INET, SOCK_STREAM
+from socket import socket, socketpair, timeout, AF_INET, SOCK_STREAM
 from socket import error as socket_error
-from struct import pack, unpack
+from socket import SOL_SOCKET, SO_KEEPALIVE, IPPROTO_TCP, SHUT_RDWR
+import socket as socket_module
+from struct import pack, unpack, Struct
+from array import array
 import sys
 import ssl
 import select
 import time
+import bisect
 import collections, itertools
+import copy
+import hashlib
+import math
+import os
 import logging
 import threading
+try:
+    import selectors
+except ImportError:
+    selectors = None
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+except ImportError: # HTTP2GatewayConnection needs the h2 package
+    h2 = None
 try:
     from ssl import wrap_socket, SSLError
 except ImportError:
-    from socket import ssl as wrap_socket, sslerror as SSLError
+    try:
+        from socket import ssl as wrap_socket, sslerror as SSLError
+    except ImportError: # Python 3.12+ only has SSLContext.wrap_socket
+        wrap_socket = None
+        from ssl import SSLError
 
 from _ssl import SSL_ERROR_WANT_READ, SSL_ERROR_WANT_WRITE
 
@@ -71,6 +94,40 @@ ENHANCED_NOTIFICATION_FORMAT = (
     '%ds' # payload
 )
 
+FRAME_COMMAND = 2
+
+FRAME_HEADER = Struct(
+    '!'   # network big-endian
+    'B'   # command
+    'I'   # frame length
+)
+
+FRAME_ITEM_HEADER = Struct(
+    '!'   # network big-endian
+    'B'   # item id
+    'H'   # item length
+)
+
+FRAME_TRAILER = Struct(
+    '!'   # network big-endian
+    'BHI' # identifier item
+    'BHI' # expiration date item
+    'BHB' # priority item
+)
+
+FEEDBACK_RECORD_HEADER = Struct(
+    '!'   # network big-endian
+    'I'   # fail time
+    'H'   # token length
+)
+
+INVALID_TOKEN_FILTER_HEADER = Struct(
+    '!'   # network big-endian
+    '4s'  # magic
+    'B'   # Bloom filter hashes, 0 for a set of tokens
+    'Q'   # tokens added
+)
+
 ERROR_RESPONSE_FORMAT = (
     '!'   # network big-endian
     'B'   # command
@@ -82,13 +139,75 @@ TOKEN_LENGTH = 32
 ERROR_RESPONSE_LENGTH = 6
 DELAY_RESEND_SEC = 0.0
 SENT_BUFFER_QTY = 100000
+SENT_BUFFER_BYTES = 32 * 1024 * 1024
+FRAME_INITIAL_SIZE = 4096
+FEEDBACK_BATCH_SIZE = 10000
+FEEDBACK_READ_SIZE = 65536
+FEEDBACK_TIMEOUT_SEC = 60
 WAIT_WRITE_TIMEOUT_SEC = 10
 WAIT_READ_TIMEOUT_SEC = 10
 WRITE_RETRY = 3
+SEND_QUEUE_BATCH = 500
+SEND_NOTIFICATIONS_CHUNK = 1000
+COALESCE_MAX_BYTES = 64 * 1024
+COALESCE_MAX_COUNT = 500
+COALESCE_MAX_DELAY_SEC = 0.01
+BROADCAST_CHUNK_SIZE = 10000
+BROADCAST_LINGER_SEC = 1.0
+BROADCAST_CLOSE_TIMEOUT_SEC = 60
+SCHEDULER_BATCH_SIZE = 100
+PRIORITY_IMMEDIATE = 10
+PRIORITY_CONSERVE_POWER = 5
+HTTP2_READ_SIZE = 65536
+KEEPALIVE_IDLE_SEC = 60
+KEEPALIVE_INTERVAL_SEC = 10
+KEEPALIVE_COUNT = 3
+INVALID_TOKEN_FILTER_MAGIC = b'APIT'
+INVALID_TOKEN_FILTER_ERROR_RATE = 0.001
+MANAGER_MAX_CONNECTIONS = 100
+MANAGER_IDLE_SEC = 300
+MANAGER_MAX_SESSIONS = 1000
+
+METRICS_SECONDS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+METRICS_SIZE_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
 
 ER_STATUS = 'status'
 ER_IDENTIFER = 'identifier'
 
+def _get_token_bin(token):
+    """
+    Returns a device token in binary form. bytearrays, memoryviews and
+    bytes of exactly TOKEN_LENGTH are taken to be binary already; anything
+    else, e.g. a str, is decoded from hex.
+    """
+    if isinstance(token, (bytearray, memoryview)):
+        return token
+    if isinstance(token, bytes) and len(token) == TOKEN_LENGTH:
+        return token
+    return a2b_hex(token)
+
+def _to_bytes(data):
+    """
+    Copies bytes-like data into bytes. On Python 2 bytes(memoryview) is
+    the view's repr, not its contents.
+    """
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(data)
+
+def _get_message_token(message):
+    """
+    Returns the binary token of a notification encoded in the enhanced or
+    the frame format, as kept in the resend window
+    """
+    if message[0:1] == b'\x02': # a frame holding one notification
+        offset = FRAME_HEADER.size
+        token_length = FRAME_ITEM_HEADER.unpack_from(message, offset)[1]
+        offset += FRAME_ITEM_HEADER.size
+    else:
+        offset, token_length = 11, TOKEN_LENGTH
+    return _to_bytes(message[offset:offset + token_length])
+
 class APNs(object):
     """A class representing an Apple Push Notification service connection"""
 
@@ -170,11 +289,154 @@ class APNs(object):
         return self._gateway_connection
 
 
+_ssl_contexts = {} # (cert_file, key_file, alpn_protocols) -> (key, context)
+_ssl_contexts_lock = threading.Lock()
+
+def _get_ssl_context(cert_file, key_file, alpn_protocols=None):
+    """
+    Returns the SSLContext shared by every connection using cert_file and
+    key_file (and offering alpn_protocols), so the PEM files are parsed
+    once. A context is rebuilt when either file is modified. Returns None
+    if SSLContext is not available. Like the legacy wrap_socket call, the
+    server certificate is not verified.
+    """
+    if not hasattr(ssl, 'SSLContext'):
+        return None
+    alpn_protocols = tuple(alpn_protocols or ())
+    key = (cert_file, key_file, alpn_protocols,
+           cert_file and os.path.getmtime(cert_file),
+           key_file and os.path.getmtime(key_file))
+    with _ssl_contexts_lock:
+        # Python 2 SSLContexts take no attributes, so the key is kept beside
+        cached_key, context = _ssl_contexts.get(key[:3], (None, None))
+        if cached_key != key:
+            context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23))
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            if cert_file:
+                context.load_cert_chain(cert_file, key_file)
+            if alpn_protocols:
+                context.set_alpn_protocols(list(alpn_protocols))
+            _ssl_contexts[key[:3]] = (key, context)
+        return context
+
+class NullMetrics(object):
+    """
+    The default metrics sink, which discards everything. Connections check
+    enabled before timing anything, so it costs next to nothing.
+    """
+    enabled = False
+
+    def increment(self, name, value=1, labels=None):
+        pass
+
+    def observe(self, name, value, labels=None):
+        pass
+
+NULL_METRICS = NullMetrics()
+
+class MetricsRegistry(NullMetrics):
+    """
+    An in-process registry of counters and histograms, exportable in the
+    Prometheus text format.
+
+    Connections report the counters notifications_sent_total,
+    notifications_resent_total, error_responses_total (labelled by
+    status), reconnects_total, dropped_writes_total and
+    notifications_dropped_total, and the histograms
+    tls_handshake_seconds, write_seconds,
+    error_response_turnaround_seconds and resend_batch_size.
+    """
+    enabled = True
+
+    def __init__(self, prefix='apns_', buckets=None):
+        super(MetricsRegistry, self).__init__()
+        self.prefix = prefix
+        self.buckets = {'resend_batch_size': METRICS_SIZE_BUCKETS}
+        if buckets:
+            self.buckets.update(buckets)
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())) if labels else ())
+
+    def increment(self, name, value=1, labels=None):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                bounds = self.buckets.get(name, METRICS_SECONDS_BUCKETS)
+                histogram = self._histograms[key] = [bounds, [0] * len(bounds), 0.0, 0]
+            bounds, counts = histogram[0], histogram[1]
+            for i, bound in enumerate(bounds):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            histogram[2] += value
+            histogram[3] += 1
+
+    def counter(self, name, labels=None):
+        """Returns the current value of a counter"""
+        return self._counters.get(self._key(name, labels), 0)
+
+    def histogram(self, name, labels=None):
+        """Returns (sum, count) of a histogram"""
+        histogram = self._histograms.get(self._key(name, labels))
+        return (histogram[2], histogram[3]) if histogram else (0.0, 0)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, v) for k, v in pairs)
+
+    def prometheus_text(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                name = self.prefix + name
+                if name not in typed:
+                    lines.append('# TYPE %s counter' % name)
+                    typed.add(name)
+                lines.append('%s%s %s' % (name, self._format_labels(labels), value))
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                bounds, counts, total, count = histogram
+                name = self.prefix + name
+                if name not in typed:
+                    lines.append('# TYPE %s histogram' % name)
+                    typed.add(name)
+                cumulative = 0
+                for bound, bucket_count in zip(bounds, counts):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket%s %d' % (
+                        name, self._format_labels(labels, [('le', repr(float(bound)))]), cumulative))
+                lines.append('%s_bucket%s %d' % (
+                    name, self._format_labels(labels, [('le', '+Inf')]), count))
+                lines.append('%s_sum%s %r' % (name, self._format_labels(labels), total))
+                lines.append('%s_count%s %d' % (name, self._format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
 class APNsConnection(object):
     """
     A generic connection class for communicating with the APNs
     """
-    def __init__(self, cert_file=None, key_file=None, timeout=None, enhanced=False):
+    def __init__(self, cert_file=None, key_file=None, timeout=None, enhanced=False,
+                 metrics=None, keepalive=False):
+        """
+        Pass a MetricsRegistry as metrics to record counters and timings.
+        Set keepalive to True to enable TCP keepalive on the socket.
+        """
         super(APNsConnection, self).__init__()
         self.cert_file = cert_file
         self.key_file = key_file
@@ -183,37 +445,54 @@ class APNsConnection(object):
         self._ssl = None
         self.enhanced = enhanced
         self.connection_alive = False
+        self.metrics = metrics or NULL_METRICS
+        self.keepalive = keepalive
+        self._connected_before = False
+        self._tls_session = None
+        self._tls_session_context = None
 
     def _connect(self):
         # Establish an SSL connection
-        _logger.debug("%s APNS connection establishing..." % self.__class__.__name__)
+        _logger.debug("%s APNS connection establishing...", self.__class__.__name__)
+        self._socket, self._ssl = self._open()
+        if self.enhanced:
+            self._last_activity_time = time.time()
+        if self._connected_before:
+            self.metrics.increment('reconnects_total')
+        self._connected_before = True
+        self.connection_alive = True
+        _logger.debug("%s APNS connection established", self.__class__.__name__)
 
+    def _open(self):
+        """Returns a new (socket, ssl socket) pair after the TLS handshake"""
         # Fallback for socket timeout.
         for i in range(3):
             try:
-                self._socket = socket(AF_INET, SOCK_STREAM)
-                self._socket.settimeout(self.timeout)
-                self._socket.connect((self.server, self.port))
+                sock = socket(AF_INET, SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                if self.keepalive:
+                    self._set_keepalive(sock)
+                sock.connect((self.server, self.port))
                 break
             except timeout:
                 pass
             except:
                 raise
 
+        handshake_start = time.time() if self.metrics.enabled else None
+        context = self._ssl_context()
         if self.enhanced:
-            self._last_activity_time = time.time()
-            self._socket.setblocking(False)
-            self._ssl = wrap_socket(self._socket, self.key_file, self.cert_file,
-                                        do_handshake_on_connect=False)
+            sock.setblocking(False)
+            ssl_sock = self._wrap_socket(sock, context, do_handshake_on_connect=False)
             while True:
                 try:
-                    self._ssl.do_handshake()
+                    ssl_sock.do_handshake()
                     break
                 except ssl.SSLError as err:
                     if ssl.SSL_ERROR_WANT_READ == err.args[0]:
-                        select.select([self._ssl], [], [])
+                        select.select([ssl_sock], [], [])
                     elif ssl.SSL_ERROR_WANT_WRITE == err.args[0]:
-                        select.select([], [self._ssl], [])
+                        select.select([], [ssl_sock], [])
                     else:
                         raise
 
@@ -221,7 +500,7 @@ class APNsConnection(object):
             # Fallback for 'SSLError: _ssl.c:489: The handshake operation timed out'
             for i in range(3):
                 try:
-                    self._ssl = wrap_socket(self._socket, self.key_file, self.cert_file)
+                    ssl_sock = self._wrap_socket(sock, context)
                     break
                 except SSLError as ex:
                     if ex.args[0] == SSL_ERROR_WANT_READ:
@@ -231,17 +510,65 @@ class APNsConnection(object):
                     else:
                        raise
 
-        self.connection_alive = True
-        _logger.debug("%s APNS connection established" % self.__class__.__name__)
+        if handshake_start is not None:
+            self.metrics.observe('tls_handshake_seconds', time.time() - handshake_start)
+            if getattr(ssl_sock, 'session_reused', False):
+                self.metrics.increment('tls_sessions_reused_total')
+        return sock, ssl_sock
+
+    def _ssl_context(self):
+        return _get_ssl_context(self.cert_file, self.key_file)
+
+    @staticmethod
+    def _set_keepalive(sock):
+        sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+        # the names and availability of the tuning options vary by platform
+        for name, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE_SEC),
+                            ('TCP_KEEPALIVE', KEEPALIVE_IDLE_SEC), # macOS
+                            ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL_SEC),
+                            ('TCP_KEEPCNT', KEEPALIVE_COUNT)):
+            option = getattr(socket_module, name, None)
+            if option is not None:
+                sock.setsockopt(IPPROTO_TCP, option, value)
+
+    def _wrap_socket(self, sock, context, **kwargs):
+        if context is None:
+            return wrap_socket(sock, self.key_file, self.cert_file, **kwargs)
+        if self._tls_session is not None and self._tls_session_context is context:
+            # resume the previous TLS session rather than a full handshake
+            kwargs['session'] = self._tls_session
+        self._tls_session_context = context
+        return context.wrap_socket(sock, server_hostname=self.server, **kwargs)
+
+    def _save_tls_session(self):
+        session = getattr(self._ssl, 'session', None)
+        if session is None:
+            return
+        if (not self.enhanced and not session.has_ticket
+                and self._ssl.version() == 'TLSv1.3'):
+            # TLS 1.3 tickets arrive after the handshake and are only
+            # processed by a read, which a simple format connection never
+            # does. APNs sends nothing else on one. On an enhanced
+            # connection the error-response reader processes the tickets,
+            # and anything left unread may be an error-response, so it is
+            # not read here.
+            try:
+                self._ssl.setblocking(False)
+                self._ssl.recv(ERROR_RESPONSE_LENGTH)
+            except (SSLError, socket_error):
+                pass
+            session = self._ssl.session
+        self._tls_session = session
 
     def _disconnect(self):
         if self.connection_alive:
+            self._save_tls_session()
             if self._socket:
                 self._socket.close()
             if self._ssl:
                 self._ssl.close()
             self.connection_alive = False
-            _logger.info(" %s APNS connection closed" % self.__class__.__name__)
+            _logger.info(" %s APNS connection closed", self.__class__.__name__)
 
     def _connection(self):
         if not self._ssl or not self.connection_alive:
@@ -253,21 +580,62 @@ class APNsConnection(object):
 
     def write(self, string):
         if self.enhanced: # nonblocking socket
-            self._last_activity_time = time.time()
+            self._last_activity_time = now = time.time()
             _, wlist, _ = select.select([], [self._connection()], [], WAIT_WRITE_TIMEOUT_SEC)
 
             if len(wlist) > 0:
-                length = self._connection().sendall(string)
-                if length == 0:
-                    _logger.debug("sent length: %d" % length) #DEBUG
+                self._sendall(string)
+                if self.metrics.enabled:
+                    self.metrics.observe('write_seconds', time.time() - now)
+                return True
             else:
-                _logger.warning("write socket descriptor is not ready after " + str(WAIT_WRITE_TIMEOUT_SEC))
+                _logger.warning("write socket descriptor is not ready after %s", WAIT_WRITE_TIMEOUT_SEC)
+                self.metrics.increment('dropped_writes_total')
+                return False
 
         else: # blocking socket
-            return self._connection().write(string)
+            if not self.metrics.enabled:
+                return self._connection().write(string)
+            start = time.time()
+            result = self._connection().write(string)
+            self.metrics.observe('write_seconds', time.time() - start)
+            return result
+
+    def _sendall(self, data):
+        # sendall() on a non-blocking SSL socket gives up as soon as the
+        # socket buffer is full, so send the rest whenever it is writable,
+        # giving up once no progress is made for WAIT_WRITE_TIMEOUT_SEC
+        view = memoryview(data)
+        deadline = time.time() + WAIT_WRITE_TIMEOUT_SEC
+        while len(view):
+            try:
+                sent = self._ssl.send(view)
+            except ssl.SSLError as err:
+                if err.args[0] not in (ssl.SSL_ERROR_WANT_WRITE, ssl.SSL_ERROR_WANT_READ):
+                    raise
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    _logger.error("APNS stopped reading, %d of %d bytes not written after %s secs",
+                                  len(view), len(data), WAIT_WRITE_TIMEOUT_SEC)
+                    self.metrics.increment('dropped_writes_total')
+                    # part of a notification may have been written
+                    self._disconnect()
+                    raise timeout("write timed out")
+                if err.args[0] == ssl.SSL_ERROR_WANT_WRITE:
+                    select.select([], [self._ssl], [], remaining)
+                else:
+                    select.select([self._ssl], [], [], remaining)
+                continue
+            view = view[sent:]
+            deadline = time.time() + WAIT_WRITE_TIMEOUT_SEC
 
 
+_alert_versions = itertools.count()
+
 class PayloadAlert(object):
+    __slots__ = ('body', 'title', 'subtitle', 'action_loc_key', 'loc_key', 'loc_args',
+                 'launch_image', '_version')
+
     def __init__(self, body=None, title = None, subtitle = None, action_loc_key=None, loc_key=None,
                  loc_args=None, launch_image=None):
         super(PayloadAlert, self).__init__()
@@ -280,6 +648,13 @@ class PayloadAlert(object):
         self.loc_args = loc_args
         self.launch_image = launch_image
 
+    def __setattr__(self, name, value):
+        super(PayloadAlert, self).__setattr__(name, value)
+        if not name.startswith('_'):
+            # lets a Payload holding this alert notice that its cached
+            # JSON is stale
+            super(PayloadAlert, self).__setattr__('_version', next(_alert_versions))
+
     def dict(self):
         d = {}
         
@@ -299,6 +674,23 @@ class PayloadAlert(object):
             d['launch-image'] = self.launch_image
         return d
 
+_JSON_SHORT_ESCAPES = u'"\\\b\f\n\r\t'
+
+def _json_length(char):
+    """Returns the bytes char takes in Payload.json()"""
+    code = ord(char)
+    if char in _JSON_SHORT_ESCAPES:
+        return 2
+    if code < 0x20:
+        return 6 # \u00XX
+    if code < 0x80:
+        return 1
+    if code < 0x800:
+        return 2
+    if code < 0x10000:
+        return 3
+    return 4
+
 class PayloadTooLargeError(Exception):
     def __init__(self, payload_size):
         super(PayloadTooLargeError, self).__init__()
@@ -306,6 +698,9 @@ class PayloadTooLargeError(Exception):
 
 class Payload(object):
     """A class representing an APNs message payload"""
+    __slots__ = ('alert', 'badge', 'sound', 'category', 'custom', 'content_available',
+                 'mutable_content', '_json', '_alert_version')
+
     def __init__(self, alert=None, badge=None, sound=None, category=None, custom=None, content_available=False,
                  mutable_content=False):
         super(Payload, self).__init__()
@@ -318,6 +713,11 @@ class Payload(object):
         self.mutable_content = mutable_content
         self._check_size()
 
+    def __setattr__(self, name, value):
+        super(Payload, self).__setattr__(name, value)
+        if not name.startswith('_'):
+            super(Payload, self).__setattr__('_json', None)
+
     def dict(self):
         """Returns the payload as a regular Python dictionary"""
         d = {}
@@ -346,8 +746,64 @@ class Payload(object):
             d.update(self.custom)
         return d
 
+    @classmethod
+    def truncated(cls, alert=None, ellipsis=u'\u2026', max_length=MAX_PAYLOAD_LENGTH,
+                  **kwargs):
+        """
+        Returns a Payload of at most max_length bytes, shortening the alert
+        body (the alert string, or the body of a PayloadAlert, which is
+        copied) and ending it with ellipsis if it does not fit. The rest of
+        the payload is encoded once and the body is cut in a single pass,
+        on a character boundary. Raises PayloadTooLargeError if the payload
+        does not fit even with the body cut to the ellipsis.
+        """
+        body = alert.body if isinstance(alert, PayloadAlert) else alert
+        if not body:
+            return cls(alert=alert, **kwargs)
+        if isinstance(alert, PayloadAlert):
+            alert = copy.copy(alert)
+            alert.body = ellipsis
+            payload = cls(alert=alert, **kwargs)
+        else:
+            payload = cls(alert=ellipsis, **kwargs)
+        ellipsis_length = sum(_json_length(char) for char in ellipsis)
+        available = max_length - (len(payload.json()) - ellipsis_length)
+
+        length = 0
+        for index, char in enumerate(body):
+            char_length = _json_length(char)
+            if length + char_length > available:
+                break
+            length += char_length
+        else:
+            index = len(body) # the whole body fits
+        if index < len(body):
+            available -= ellipsis_length
+            while length > available and index:
+                index -= 1
+                length -= _json_length(body[index])
+            if length > available:
+                raise PayloadTooLargeError(max_length - available)
+            body = body[:index].rstrip() + ellipsis
+
+        if isinstance(alert, PayloadAlert):
+            alert.body = body
+        else:
+            payload.alert = body
+        payload._check_size()
+        return payload
+
     def json(self):
-        return json.dumps(self.dict(), separators=(',',':'), ensure_ascii=False).encode('utf-8')
+        """
+        Returns the payload encoded as JSON bytes. The encoding is cached
+        until an attribute of the payload or of its PayloadAlert is
+        assigned; reassign custom rather than mutating it in place.
+        """
+        alert_version = getattr(self.alert, '_version', None)
+        if self._json is None or alert_version != self._alert_version:
+            self._json = json.dumps(self.dict(), separators=(',',':'), ensure_ascii=False).encode('utf-8')
+            self._alert_version = alert_version
+        return self._json
 
     def _check_size(self):
         payload_length = len(self.json())
@@ -359,56 +815,127 @@ class Payload(object):
         args = ", ".join(["%s=%r" % (n, getattr(self, n)) for n in attrs])
         return "%s(%s)" % (self.__class__.__name__, args)
 
+class FrameItem(object):
+    """
+    A notification added to a Frame. Fields can also be read by key, as
+    in item['identifier'], like the dicts Frame used to keep.
+    """
+    __slots__ = ('token', 'payload', 'identifier', 'expiry', 'priority')
+
+    def __init__(self, token, payload, identifier, expiry, priority):
+        self.token = token
+        self.payload = payload
+        self.identifier = identifier
+        self.expiry = expiry
+        self.priority = priority
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __repr__(self):
+        return "FrameItem(%r, %r, %r, %r, %r)" % (
+            self.token, self.payload, self.identifier, self.expiry, self.priority)
+
 class Frame(object):
-    """A class representing an APNs message frame for multiple sending"""
-    def __init__(self):
+    """
+    A class representing an APNs message frame for multiple sending.
+
+    Items are packed in place into frame_data, each as a frame of its own,
+    and their offsets recorded. If max_size is given, get_frames() splits
+    the frame into chunks of at most max_size bytes, on notification
+    boundaries.
+
+    get_frame_view(), get_frames() and get_item_messages() return
+    memoryviews of frame_data rather than copies; items cannot be added
+    while any of them is still referenced.
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
         self.frame_data = bytearray()
+        self._segments = [0]
+        self._item_offsets = array('I')
         self.notification_data = list()
 
     def get_frame(self):
         return self.frame_data
 
-    def add_item(self, token_hex, payload, identifier, expiry, priority):
-        """Add a notification message to the frame"""
-        item_len = 0
-        self.frame_data.extend(b'\2' + APNs.packed_uint_big_endian(item_len))
+    def get_frame_view(self):
+        """Returns the whole frame as a memoryview, without copying"""
+        return memoryview(self.frame_data)
 
-        token_bin = a2b_hex(token_hex)
-        token_length_bin = APNs.packed_ushort_big_endian(len(token_bin))
-        token_item = b'\1' + token_length_bin + token_bin
-        self.frame_data.extend(token_item)
-        item_len += len(token_item)
+    def get_frames(self):
+        """Returns memoryviews of the frame split into chunks of at most max_size bytes"""
+        view = memoryview(self.frame_data)
+        bounds = self._segments + [len(self.frame_data)]
+        return [view[bounds[i]:bounds[i + 1]] for i in range(len(self._segments))
+                if bounds[i] < bounds[i + 1]]
 
+    def add_item(self, token, payload, identifier, expiry, priority):
+        """
+        Add a notification message to the frame. The token may be a hex
+        string or TOKEN_LENGTH bytes of binary token.
+        """
+        # a copy, so the frame holds no view of e.g. a TokenStore's mmap
+        token_bin = _to_bytes(_get_token_bin(token))
         payload_json = payload.json()
-        payload_length_bin = APNs.packed_ushort_big_endian(len(payload_json))
-        payload_item = b'\2' + payload_length_bin + payload_json
-        self.frame_data.extend(payload_item)
-        item_len += len(payload_item)
-
-        identifier_bin = APNs.packed_uint_big_endian(identifier)
-        identifier_length_bin = \
-                APNs.packed_ushort_big_endian(len(identifier_bin))
-        identifier_item = b'\3' + identifier_length_bin + identifier_bin
-        self.frame_data.extend(identifier_item)
-        item_len += len(identifier_item)
-
-        expiry_bin = APNs.packed_uint_big_endian(expiry)
-        expiry_length_bin = APNs.packed_ushort_big_endian(len(expiry_bin))
-        expiry_item = b'\4' + expiry_length_bin + expiry_bin
-        self.frame_data.extend(expiry_item)
-        item_len += len(expiry_item)
-
-        priority_bin = APNs.packed_uchar(priority)
-        priority_length_bin = APNs.packed_ushort_big_endian(len(priority_bin))
-        priority_item = b'\5' + priority_length_bin + priority_bin
-        self.frame_data.extend(priority_item)
-        item_len += len(priority_item)
-
-        self.frame_data[-item_len-4:-item_len] = APNs.packed_uint_big_endian(item_len)
+        token_length = len(token_bin)
+        payload_length = len(payload_json)
+        item_length = (FRAME_ITEM_HEADER.size * 2 + token_length
+                       + payload_length + FRAME_TRAILER.size)
+        size = FRAME_HEADER.size + item_length
+
+        buff = self.frame_data
+        offset = len(buff)
+        if (self.max_size and offset > self._segments[-1]
+                and offset + size - self._segments[-1] > self.max_size):
+            self._segments.append(offset)
+
+        buff += bytearray(size)
+        self._item_offsets.append(offset)
+        FRAME_HEADER.pack_into(buff, offset, FRAME_COMMAND, item_length)
+        offset += FRAME_HEADER.size
+        FRAME_ITEM_HEADER.pack_into(buff, offset, 1, token_length)
+        offset += FRAME_ITEM_HEADER.size
+        buff[offset:offset + token_length] = token_bin
+        offset += token_length
+        FRAME_ITEM_HEADER.pack_into(buff, offset, 2, payload_length)
+        offset += FRAME_ITEM_HEADER.size
+        buff[offset:offset + payload_length] = payload_json
+        offset += payload_length
+        FRAME_TRAILER.pack_into(buff, offset, 3, 4, identifier, 4, 4, expiry,
+                                5, 1, priority)
+
+        self.notification_data.append(FrameItem(token_bin, payload, identifier, expiry, priority))
+
+    def add_tokens(self, tokens, payload, identifier, expiry, priority):
+        """
+        Add the same payload for each of tokens, which may be a TokenStore
+        or any iterable of tokens. Identifiers are assigned consecutively
+        starting at identifier.
+        """
+        for token in tokens:
+            self.add_item(token, payload, identifier & 0xffffffff, expiry, priority)
+            identifier += 1
 
-        self.notification_data.append({'token':token_hex, 'payload':payload, 'identifier':identifier, 'expiry':expiry, "priority":priority})
+    def get_item_messages(self):
+        """
+        Yields (identifier, message) for each item, message being a
+        memoryview of the item's own frame within the frame buffer
+        """
+        view = memoryview(self.frame_data)
+        offsets = self._item_offsets
+        last = len(offsets) - 1
+        for i, item in enumerate(self.notification_data):
+            end = offsets[i + 1] if i < last else len(view)
+            yield item.identifier, view[offsets[i]:end]
 
     def get_notifications(self, gateway_connection):
+        """
+        Returns the items re-encoded in the enhanced format, as dicts of
+        'id' and 'message'. get_item_messages() avoids the encoding.
+        """
         notifications = list({'id': x['identifier'], 'message':gateway_connection._get_enhanced_notification(x['token'], x['payload'],x['identifier'], x['expiry'])} for x in self.notification_data)
         return notifications
 
@@ -416,32 +943,234 @@ class Frame(object):
         """Get the frame buffer"""
         return str(self.frame_data)
 
+class TokenStore(object):
+    """
+    A compact store of binary device tokens packed back to back,
+    TOKEN_LENGTH bytes each. Stores opened from a file are memory-mapped
+    read-only; others can be appended to and saved.
+
+    Iterating yields each token as a memoryview, which every send API
+    accepts without hex decoding.
+    """
+    def __init__(self, data=b''):
+        super(TokenStore, self).__init__()
+        if len(data) % TOKEN_LENGTH:
+            raise ValueError("data is not a multiple of %d bytes" % TOKEN_LENGTH)
+        self._data = bytearray(data)
+        self._mmap = None
+
+    @classmethod
+    def from_hex(cls, tokens):
+        """Builds a store from an iterable of hex tokens, e.g. a file of lines"""
+        store = cls()
+        for token in tokens:
+            token = token.strip()
+            if token:
+                store.append(token)
+        return store
+
+    @classmethod
+    def open(cls, path):
+        """
+        Memory-maps a file written by save(). Python 2 cannot take a
+        memoryview of an mmap, so there the file is read instead.
+        """
+        import mmap
+        store = cls()
+        with open(path, 'rb') as f:
+            f.seek(0, 2)
+            if f.tell():
+                store._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if len(store._mmap) % TOKEN_LENGTH:
+                    store.close()
+                    raise ValueError("%s is not a multiple of %d bytes" % (path, TOKEN_LENGTH))
+                try:
+                    memoryview(store._mmap)
+                except TypeError:
+                    store.close()
+                    f.seek(0)
+                    store._data = bytearray(f.read())
+                else:
+                    store._data = store._mmap
+        return store
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self._data)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+            self._data = bytearray()
+
+    def append(self, token):
+        """Adds a token given as hex or TOKEN_LENGTH binary bytes"""
+        token_bin = _get_token_bin(token)
+        if len(token_bin) != TOKEN_LENGTH:
+            raise ValueError("token must be %d bytes" % TOKEN_LENGTH)
+        self._data += token_bin
+
+    def extend(self, tokens):
+        for token in tokens:
+            self.append(token)
+
+    def __len__(self):
+        return len(self._data) // TOKEN_LENGTH
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("token index out of range")
+        offset = index * TOKEN_LENGTH
+        return memoryview(self._data)[offset:offset + TOKEN_LENGTH]
+
+    def __iter__(self):
+        view = memoryview(self._data)
+        for offset in range(0, len(view), TOKEN_LENGTH):
+            yield view[offset:offset + TOKEN_LENGTH]
+
+    def chunks(self, size):
+        """Yields copies of consecutive runs of up to size tokens as TokenStores"""
+        step = size * TOKEN_LENGTH
+        view = memoryview(self._data)
+        for offset in range(0, len(view), step):
+            yield TokenStore(view[offset:offset + step])
+
+class InvalidTokenFilter(object):
+    """
+    The device tokens known to be invalid, checked before a notification
+    is encoded so it is never sent. Fed by status 8 error-responses and by
+    the feedback service.
+
+    By default the tokens are kept in a set, which is exact but costs about
+    100 bytes a token. Give capacity to use a Bloom filter instead, sized
+    for capacity tokens at error_rate false positives: 1.8 bytes a token
+    at the default 0.1%, but a valid token is skipped once in a thousand.
+    """
+    def __init__(self, capacity=None, error_rate=INVALID_TOKEN_FILTER_ERROR_RATE):
+        super(InvalidTokenFilter, self).__init__()
+        self._lock = threading.Lock()
+        self._count = 0
+        if capacity is None:
+            self._tokens = set()
+            self._bits = None
+            self._hashes = 0
+        else:
+            size = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+            self._tokens = None
+            self._bits = bytearray(max(1, int(math.ceil(size / 8))))
+            self._hashes = max(1, int(round(size / capacity * math.log(2))))
+
+    @classmethod
+    def load(cls, path):
+        """Reads a filter written by save()"""
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, hashes, count = INVALID_TOKEN_FILTER_HEADER.unpack_from(data)
+        if magic != INVALID_TOKEN_FILTER_MAGIC:
+            raise ValueError("%s is not an invalid token filter" % path)
+        body = data[INVALID_TOKEN_FILTER_HEADER.size:]
+        token_filter = cls()
+        if hashes:
+            token_filter._tokens = None
+            token_filter._bits = bytearray(body)
+            token_filter._hashes = hashes
+        else:
+            if len(body) % TOKEN_LENGTH:
+                raise ValueError("%s is truncated" % path)
+            token_filter._tokens = set(body[offset:offset + TOKEN_LENGTH]
+                                       for offset in range(0, len(body), TOKEN_LENGTH))
+        token_filter._count = count
+        return token_filter
+
+    def save(self, path):
+        """Writes the filter to path, replacing it atomically"""
+        with self._lock:
+            header = INVALID_TOKEN_FILTER_HEADER.pack(INVALID_TOKEN_FILTER_MAGIC,
+                                                      self._hashes, self._count)
+            body = self._bits if self._bits is not None else b''.join(self._tokens)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(header)
+                f.write(body)
+        getattr(os, 'replace', os.rename)(path + '.tmp', path)
+
+    def _positions(self, token):
+        h1, h2 = unpack('>QQ', hashlib.sha1(token).digest()[:16])
+        h2 |= 1 # odd, so never a multiple of the even size, repeating one position
+        size = len(self._bits) * 8
+        for i in range(self._hashes):
+            yield (h1 + i * h2) % size
+
+    def add(self, token):
+        """Adds a token given as hex or binary"""
+        token = _to_bytes(_get_token_bin(token))
+        with self._lock:
+            if self._bits is None:
+                if token in self._tokens:
+                    return
+                self._tokens.add(token)
+            else:
+                for position in self._positions(token):
+                    self._bits[position >> 3] |= 1 << (position & 7)
+            self._count += 1
+
+    def update(self, tokens):
+        for token in tokens:
+            self.add(token)
+
+    def __contains__(self, token):
+        token = _to_bytes(_get_token_bin(token))
+        if self._bits is None:
+            return token in self._tokens
+        bits = self._bits
+        for position in self._positions(token):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        """The number of tokens added; for a Bloom filter repeats are counted"""
+        return self._count
+
 class FeedbackConnection(APNsConnection):
     """
     A class representing a connection to the APNs Feedback server
     """
-    def __init__(self, use_sandbox=False, **kwargs):
+    def __init__(self, use_sandbox=False, invalid_tokens=None, **kwargs):
+        """
+        Every token read is added to invalid_tokens if it is given, an
+        InvalidTokenFilter, once it has been handed off: when the caller
+        asks for the next item or batch. A token the caller failed to store
+        is not filtered, so it is not silently lost.
+        """
         super(FeedbackConnection, self).__init__(**kwargs)
         self.server = (
             'feedback.push.apple.com',
             'feedback.sandbox.push.apple.com')[use_sandbox]
         self.port = 2196
+        self.invalid_tokens = invalid_tokens
 
     def _chunks(self):
-        BUF_SIZE = 4096
         while 1:
-            data = self.read(BUF_SIZE)
+            data = self.read(FEEDBACK_READ_SIZE)
             yield data
             if not data:
                 break
 
-    def items(self):
+    def _records(self):
         """
-        A generator that yields (token_hex, fail_time) pairs retrieved from
-        the APNs feedback server
+        Parses the feedback stream incrementally, yielding
+        (buff, offset, fail_time_unix, token_length) for every complete
+        record. The token is buff[offset:offset + token_length] and is only
+        valid until the next record is requested.
         """
-        buff = b''
+        buff = bytearray()
+        consumed = 0
         for chunk in self._chunks():
+            # drop parsed records in one go rather than once per record
+            del buff[:consumed]
             buff += chunk
 
             # Quit if there's no more data to read
@@ -453,29 +1182,526 @@ class FeedbackConnection(APNsConnection):
             if len(buff) < 6:
                 break
 
-            while len(buff) > 6:
-                token_length = APNs.unpacked_ushort_big_endian(buff[4:6])
-                bytes_to_read = 6 + token_length
-                if len(buff) >= bytes_to_read:
-                    fail_time_unix = APNs.unpacked_uint_big_endian(buff[0:4])
-                    fail_time = datetime.utcfromtimestamp(fail_time_unix)
-                    token = b2a_hex(buff[6:bytes_to_read])
+            offset = 0
+            size = len(buff)
+            while size - offset > 6:
+                fail_time_unix, token_length = FEEDBACK_RECORD_HEADER.unpack_from(buff, offset)
+                end = offset + FEEDBACK_RECORD_HEADER.size + token_length
+                if end > size:
+                    # go and fetch some more data and append to buffer
+                    break
+                yield buff, offset + FEEDBACK_RECORD_HEADER.size, fail_time_unix, token_length
+                offset = end
+            consumed = offset
+
+    def items(self):
+        """
+        A generator that yields (token_hex, fail_time) pairs retrieved from
+        the APNs feedback server
+        """
+        invalid_tokens = self.invalid_tokens
+        for buff, offset, fail_time_unix, token_length in self._records():
+            token = b2a_hex(buff[offset:offset + token_length])
+            yield (token, datetime.utcfromtimestamp(fail_time_unix))
+            if invalid_tokens is not None:
+                invalid_tokens.add(bytes(buff[offset:offset + token_length]))
+
+    def items_batch(self, batch_size=FEEDBACK_BATCH_SIZE):
+        """
+        A generator that yields the feedback in batches of up to batch_size
+        records as (tokens, fail_times) pairs: tokens is a bytearray of
+        binary tokens laid back to back, TOKEN_LENGTH bytes each, and
+        fail_times an array of unix timestamps.
+        """
+        tokens = bytearray()
+        fail_times = array('I')
+        for buff, offset, fail_time_unix, token_length in self._records():
+            tokens += memoryview(buff)[offset:offset + token_length]
+            fail_times.append(fail_time_unix)
+            if len(fail_times) >= batch_size:
+                yield tokens, fail_times
+                self._add_invalid_tokens(tokens)
+                tokens = bytearray()
+                fail_times = array('I')
+        if fail_times:
+            yield tokens, fail_times
+            self._add_invalid_tokens(tokens)
+
+    def _add_invalid_tokens(self, tokens):
+        if self.invalid_tokens is not None:
+            self.invalid_tokens.update(bytes(tokens[offset:offset + TOKEN_LENGTH])
+                                       for offset in range(0, len(tokens), TOKEN_LENGTH))
+
+class SQLiteFeedbackSink(object):
+    """
+    A FeedbackHarvester sink keeping feedback in an SQLite database, one
+    row per app and token with the latest fail time
+    """
+    def __init__(self, path):
+        import sqlite3
+        super(SQLiteFeedbackSink, self).__init__()
+        self._binary = sqlite3.Binary # a BLOB on Python 2 too, where bytes is str
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("CREATE TABLE IF NOT EXISTS feedback ("
+                             "app TEXT, token BLOB, fail_time INTEGER, "
+                             "PRIMARY KEY (app, token))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS checkpoints ("
+                             "app TEXT PRIMARY KEY, harvested_at REAL)")
+            self._db.commit()
+
+    def add(self, app, tokens, fail_times):
+        binary = self._binary
+        rows = [(fail_time, app, binary(bytes(tokens[i * TOKEN_LENGTH:(i + 1) * TOKEN_LENGTH])))
+                for i, fail_time in enumerate(fail_times)]
+        with self._lock:
+            # a token reported again keeps its latest fail time, whatever
+            # order the batches arrive in. ON CONFLICT DO UPDATE would need
+            # SQLite 3.24.
+            self._db.executemany("INSERT OR IGNORE INTO feedback (fail_time, app, token) "
+                                 "VALUES (?, ?, ?)", rows)
+            self._db.executemany("UPDATE feedback SET fail_time = MAX(fail_time, ?) "
+                                 "WHERE app = ? AND token = ?", rows)
+            self._db.commit()
+
+    def get_checkpoint(self, app):
+        with self._lock:
+            row = self._db.execute("SELECT harvested_at FROM checkpoints WHERE app = ?",
+                                   (app,)).fetchone()
+        return row[0] if row else None
+
+    def set_checkpoint(self, app, harvested_at):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?)",
+                             (app, harvested_at))
+            self._db.commit()
+
+    def items(self, app):
+        """Yields the (token_hex, fail_time) pairs stored for app"""
+        with self._lock:
+            rows = self._db.execute("SELECT token, fail_time FROM feedback WHERE app = ? "
+                                    "ORDER BY fail_time", (app,)).fetchall()
+        for token, fail_time in rows:
+            yield b2a_hex(token), datetime.utcfromtimestamp(fail_time)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class FeedbackHarvester(object):
+    """
+    Polls the feedback service for many apps at once on a pool of threads,
+    storing each batch in sink as it arrives.
+
+    apps maps an app name to the keyword arguments of its FeedbackConnection,
+    e.g. {'news': {'cert_file': 'news.pem', 'use_sandbox': False}}. Once an
+    app has been read in full its checkpoint is set, and run() skips apps
+    harvested less than interval secs ago, so running again after a crash
+    only polls the apps that did not finish. Feedback already stored is
+    kept, and APNs does not send it twice.
+
+    sink is any object with these methods, which may be called from several
+    threads at once; SQLiteFeedbackSink is one:
+
+    add(app, tokens, fail_times) stores a batch of feedback for app, as
+    yielded by FeedbackConnection.items_batch(). It must be stored durably
+    before returning, as APNs does not send it again.
+    get_checkpoint(app) returns when app was last harvested in full, or None.
+    set_checkpoint(app, harvested_at) records that.
+    """
+    def __init__(self, apps, sink, threads=8, interval=0,
+                 batch_size=FEEDBACK_BATCH_SIZE, timeout=FEEDBACK_TIMEOUT_SEC):
+        super(FeedbackHarvester, self).__init__()
+        self.apps = apps
+        self.sink = sink
+        self.threads = threads
+        self.interval = interval
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.errors = {}
+
+    def _open_connection(self, app):
+        kwargs = dict(self.apps[app])
+        kwargs.setdefault('timeout', self.timeout)
+        return FeedbackConnection(**kwargs)
+
+    def _harvest(self, app):
+        # any failure is the app's alone; the others are harvested regardless
+        started = time.time()
+        count = 0
+        try:
+            connection = self._open_connection(app)
+            try:
+                for tokens, fail_times in connection.items_batch(self.batch_size):
+                    self.sink.add(app, tokens, fail_times)
+                    count += len(fail_times)
+            finally:
+                connection._disconnect()
+            self.sink.set_checkpoint(app, started)
+        except Exception as e:
+            _logger.exception("harvesting feedback for %s failed after %d records: %s: %s",
+                              app, count, type(e), e)
+            return app, count, e
+        return app, count, None
+
+    def run(self):
+        """
+        Harvests every app that is due, and returns a dict of the number of
+        records read per app. Apps that failed are in errors, and have no
+        new checkpoint.
+        """
+        now = time.time()
+        due = []
+        for app in self.apps:
+            harvested_at = self.sink.get_checkpoint(app)
+            if harvested_at is None or now - harvested_at >= self.interval:
+                due.append(app)
+        self.errors = {}
+        counts = {}
+        if not due:
+            return counts
+        import multiprocessing.pool
+        pool = multiprocessing.pool.ThreadPool(min(self.threads, len(due)))
+        try:
+            for app, count, error in pool.imap_unordered(self._harvest, due):
+                counts[app] = count
+                if error is not None:
+                    self.errors[app] = error
+        finally:
+            pool.close()
+            pool.join()
+        return counts
+
+class SentNotificationBuffer(object):
+    """
+    A ring buffer of the most recently sent notifications, indexed by
+    identifier, used to resend notifications after an error-response.
+
+    Messages are copied into one bytes arena of at most max_bytes bytes;
+    identifiers, offsets and lengths are kept in arrays. The oldest
+    entries are discarded once maxlen entries or max_bytes bytes are held.
+    While identifiers increase they are found by binary search, otherwise
+    through a dict index built the first time one does not. Resending the
+    k entries after an identifier is O(k).
+
+    Like Util.getListIndexFromID, an identifier sent more than once is
+    taken to mean its oldest buffered copy, so a resend after it covers
+    every later copy too.
+    """
+    def __init__(self, maxlen=SENT_BUFFER_QTY, max_bytes=SENT_BUFFER_BYTES,
+                 track_times=False):
+        super(SentNotificationBuffer, self).__init__()
+        self.maxlen = maxlen
+        self.max_bytes = max_bytes
+        self.track_times = track_times
+        self.clear()
+
+    def clear(self):
+        self._ids = array('I')
+        self._offsets = array('I')
+        self._lengths = array('I')
+        self._times = array('d')
+        self._arena = bytearray(min(FRAME_INITIAL_SIZE, self.max_bytes))
+        self._index = None # identifier -> last sequence number, once needed
+        self._repeated = False # whether an identifier is buffered twice
+        self._head = 0 # sequence number of the next entry
+        self._tail = 0 # sequence number of the oldest entry
+        self._write_pos = 0
+
+    def __len__(self):
+        return self._head - self._tail
+
+    def _evict_from(self, start, end):
+        # drop the oldest entries while they lie in [start, end) of the arena
+        while self._tail < self._head:
+            offset = self._offsets[self._tail % self.maxlen]
+            if not start <= offset < end:
+                break
+            self._tail += 1
+
+    def append(self, identifier, message):
+        length = len(message)
+        if length > self.max_bytes:
+            raise ValueError("message of %d bytes exceeds buffer size" % length)
+        if self._head - self._tail == self.maxlen:
+            self._tail += 1
+
+        start = self._write_pos
+        end = start + length
+        if end > len(self._arena) and len(self._arena) < self.max_bytes:
+            arena = bytearray(min(max(2 * len(self._arena), end), self.max_bytes))
+            arena[:start] = memoryview(self._arena)[:start]
+            self._arena = arena
+        if end > len(self._arena):
+            # wrap around, discarding the entries left at the end of the arena
+            self._evict_from(start, len(self._arena))
+            start, end = 0, length
+        self._evict_from(start, end)
+        self._arena[start:end] = message
+        self._write_pos = end
+
+        seq = self._head
+        slot = seq % self.maxlen
+        if (self._index is None and self._tail < seq
+                and identifier <= self._ids[(seq - 1) % self.maxlen]):
+            self._index = dict((self._ids[s % self.maxlen], s)
+                               for s in range(self._tail, seq))
+        if slot == len(self._ids):
+            self._ids.append(identifier)
+            self._offsets.append(start)
+            self._lengths.append(length)
+            if self.track_times:
+                self._times.append(time.time())
+        else:
+            old_identifier = self._ids[slot]
+            if (self._index is not None
+                    and self._index.get(old_identifier) == seq - self.maxlen):
+                del self._index[old_identifier]
+            self._ids[slot] = identifier
+            self._offsets[slot] = start
+            self._lengths[slot] = length
+            if self.track_times:
+                self._times[slot] = time.time()
+        if self._index is not None:
+            last = self._index.get(identifier)
+            if last is not None and last >= self._tail:
+                self._repeated = True
+            self._index[identifier] = seq
+        self._head = seq + 1
+
+    def _find(self, identifier):
+        if self._index is not None:
+            seq = self._index.get(identifier)
+            if seq is None or seq < self._tail:
+                return None
+            if self._repeated:
+                # the index has the last copy; an older one may be buffered
+                ids = self._ids
+                maxlen = self.maxlen
+                for earlier in range(self._tail, seq):
+                    if ids[earlier % maxlen] == identifier:
+                        return earlier
+            return seq
+        ids = self._ids
+        maxlen = self.maxlen
+        low, high = self._tail, self._head
+        while low < high:
+            middle = (low + high) // 2
+            if ids[middle % maxlen] < identifier:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._head and ids[low % maxlen] == identifier:
+            return low
+        return None
+
+    def _message(self, seq):
+        slot = seq % self.maxlen
+        offset = self._offsets[slot]
+        return memoryview(self._arena)[offset:offset + self._lengths[slot]]
+
+    def get(self, identifier):
+        """Returns a copy of the buffered message sent with identifier, or None"""
+        seq = self._find(identifier)
+        return None if seq is None else _to_bytes(self._message(seq))
+
+    def sent_time(self, identifier):
+        """
+        Returns when the message sent with identifier was buffered, or None
+        if it is not buffered or track_times is off
+        """
+        seq = self._find(identifier)
+        if seq is None or not self.track_times:
+            return None
+        return self._times[seq % self.maxlen]
+
+    def drop_through(self, identifier):
+        """
+        Discards every entry up to and including the one sent with
+        identifier. Returns False if identifier is not buffered.
+        """
+        seq = self._find(identifier)
+        if seq is None:
+            return False
+        self._tail = seq + 1
+        return True
 
-                    yield (token, fail_time)
+    def __iter__(self):
+        """
+        Yields (identifier, message) pairs, oldest first. Messages are
+        memoryviews of the arena, only valid until the next append.
+        """
+        for seq in range(self._tail, self._head):
+            yield self._ids[seq % self.maxlen], self._message(seq)
 
-                    # Remove data for current token from buffer
-                    buff = buff[bytes_to_read:]
-                else:
-                    # break out of inner while loop - i.e. go and fetch
-                    # some more data and append to buffer
-                    break
+class SendQueueFull(Exception):
+    """Raised when a notification cannot be queued in time"""
+    pass
+
+class SendQueueClosed(Exception):
+    """Raised when a notification is queued after the queue was closed"""
+    pass
+
+class SendQueue(object):
+    """
+    A bounded queue of encoded notifications waiting to be written.
+
+    Once high_water notifications are queued, producers wait until the
+    writer has drained the queue down to low_water, so they are throttled
+    to what the gateway actually accepts.
+    """
+    def __init__(self, high_water, low_water=None):
+        super(SendQueue, self).__init__()
+        self.high_water = high_water
+        self.low_water = high_water // 2 if low_water is None else low_water
+        self._items = collections.deque()
+        self._unfinished = 0
+        self._paused = False
+        self._closed = False
+        self._has_writer = False
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._not_empty = threading.Condition(self._lock)
+        self._all_done = threading.Condition(self._lock)
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Queues item. While the queue is above its high water mark this
+        waits, raising SendQueueFull if block is False or timeout seconds
+        pass first. Raises SendQueueClosed once the queue is closed, as
+        nothing would write the item.
+        """
+        with self._lock:
+            if self._paused and not self._closed:
+                if not block:
+                    raise SendQueueFull()
+                deadline = None if timeout is None else time.time() + timeout
+                while self._paused and not self._closed:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise SendQueueFull()
+                    self._not_full.wait(remaining)
+            if self._closed:
+                raise SendQueueClosed()
+            self._items.append(item)
+            self._unfinished += 1
+            if len(self._items) >= self.high_water:
+                self._paused = True
+            self._not_empty.notify()
+
+    def get_batch(self, max_items, timeout=None):
+        """
+        Removes and returns up to max_items items, waiting up to timeout
+        seconds for the first one. Returns an empty list on timeout or once
+        the queue is closed and empty.
+        """
+        with self._lock:
+            if not self._items and not self._closed:
+                self._not_empty.wait(timeout)
+            batch = []
+            while self._items and len(batch) < max_items:
+                batch.append(self._items.popleft())
+            if self._paused and len(self._items) <= self.low_water:
+                self._paused = False
+                self._not_full.notify_all()
+            return batch
+
+    def task_done(self, count=1):
+        """Marks count items returned by get_batch as written"""
+        with self._lock:
+            self._unfinished -= count
+            if self._unfinished <= 0:
+                self._all_done.notify_all()
+
+    def join(self, timeout=None):
+        """Waits until every queued item has been written"""
+        with self._lock:
+            deadline = None if timeout is None else time.time() + timeout
+            while self._unfinished > 0:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._all_done.wait(remaining)
+            return True
+
+    def claim_writer(self):
+        """Returns True if the caller should start a writer for this queue"""
+        with self._lock:
+            if self._has_writer:
+                return False
+            self._has_writer = True
+            return True
+
+    def release_writer(self):
+        """
+        Called by a writer about to exit. Returns False if items arrived in
+        the meantime and the writer should carry on.
+        """
+        with self._lock:
+            if self._items:
+                return False
+            self._has_writer = False
+            return True
+
+    def close(self):
+        """
+        Wakes the writer so it can exit once the queue is drained, and
+        turns away producers
+        """
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
 
 class GatewayConnection(APNsConnection):
     """
     A class that represents a connection to the APNs gateway server
     """
 
-    def __init__(self, use_sandbox=False, **kwargs):
+    def __init__(self, use_sandbox=False, coalesce=False,
+                 coalesce_bytes=COALESCE_MAX_BYTES, coalesce_count=COALESCE_MAX_COUNT,
+                 coalesce_delay=COALESCE_MAX_DELAY_SEC, reactor=None,
+                 send_queue_size=None, send_queue_low_water=None, warm=False,
+                 single_writer=False, invalid_tokens=None, **kwargs):
+        """
+        Set coalesce to True (enhanced mode only) to collect notifications
+        in a buffer that is written when it holds coalesce_bytes bytes or
+        coalesce_count notifications, coalesce_delay seconds after its first
+        notification, or when flush() is called.
+
+        In enhanced mode error-responses are read by a thread per
+        connection, unless reactor is given: True for the process-wide
+        ErrorResponseReactor, or an ErrorResponseReactor instance.
+
+        Set send_queue_size (enhanced mode only) to use
+        enqueue_notification(), which queues notifications for a writer
+        thread and makes producers wait once send_queue_size are queued,
+        until the queue drains to send_queue_low_water.
+
+        Set warm to True (enhanced mode only) to keep the connection open
+        while idle, with TCP keepalive, to reconnect in the background
+        whenever it is closed, and to hold a spare connection, already
+        through its TLS handshake, ready to replace it. Call warm_up() to
+        connect ahead of the first notification. Warming stops at
+        force_close().
+
+        Set single_writer to True (enhanced mode only) to hand every
+        notification to one writer thread that owns the socket and the
+        resend window: producer threads only append to a queue, and the
+        writer also reads error-responses and resends. It cannot be
+        combined with coalesce, reactor, send_queue_size or warm.
+
+        Give invalid_tokens, an InvalidTokenFilter, to skip notifications
+        to the tokens in it before they are encoded. In enhanced mode the
+        token of every status 8 error-response is added to it.
+        """
+        self.warm = warm and kwargs.get('enhanced', False)
+        if self.warm:
+            kwargs.setdefault('keepalive', True)
         super(GatewayConnection, self).__init__(**kwargs)
         self.server = (
             'gateway.push.apple.com',
@@ -488,20 +1714,146 @@ class GatewayConnection(APNsConnection):
             self._error_response_handler_worker = None
             self._response_listener = None
 
-        self._sent_notifications = collections.deque(maxlen=SENT_BUFFER_QTY)
+        self.coalesce = coalesce and self.enhanced
+        self.coalesce_bytes = coalesce_bytes
+        self.coalesce_count = coalesce_count
+        self.coalesce_delay = coalesce_delay
+        self._outbound = bytearray()
+        self._outbound_count = 0
+        self._flush_timer = None
+
+        if reactor is True:
+            if selectors is None:
+                _logger.warning("selectors module not available, "
+                                "using an error-response thread per connection")
+                reactor = None
+            else:
+                reactor = ErrorResponseReactor.shared()
+        self._reactor = reactor if self.enhanced else None
+
+        self._send_queue = None
+        self._send_queue_writer = None
+        if send_queue_size and self.enhanced:
+            self._send_queue = SendQueue(send_queue_size, send_queue_low_water)
+
+        self._sent_notifications = SentNotificationBuffer(track_times=self.metrics.enabled)
+        self._resent_count = 0
+        self._pending_resend = None # identifier failed, to resend after
+        self._summaries = [] # of send_notifications() calls in progress
+        self.invalid_tokens = invalid_tokens
+
+        self.single_writer = single_writer and self.enhanced
+        if self.single_writer and (self.coalesce or self._reactor or self._send_queue
+                                   or self.warm):
+            raise ValueError("single_writer cannot be combined with coalesce, "
+                             "reactor, send_queue_size or warm")
+        self._writer_queue = collections.deque()
+        self._writer_thread = None
+        self._writer_lock = threading.Lock()
+        self._writer_idle = threading.Condition(self._writer_lock)
+        self._writer_waiting = False
+        self._writer_busy = False
+        self._writer_closed = False
+        self._writer_wakeup = None
+
+        self._closed = False
+        self._standby = None
+        self._warm_lock = threading.Lock()
+        self._warming = False
+
+    def _connect(self):
+        super(GatewayConnection, self)._connect()
+        if self._reactor:
+            self._reactor.register(self)
+        if self.warm:
+            self._schedule_warm_up() # replace the standby just used
+
+    def _disconnect(self):
+        was_alive = self.connection_alive
+        if self._reactor and was_alive:
+            self._reactor.unregister(self)
+        super(GatewayConnection, self)._disconnect()
+        if was_alive and self.warm:
+            self._schedule_warm_up()
+
+    def _open(self):
+        with self._warm_lock:
+            standby, self._standby = self._standby, None
+        if standby is not None:
+            sock, ssl_sock = standby
+            # anything readable on an unused connection means APNs closed it
+            if self._is_standby_usable(ssl_sock):
+                self.metrics.increment('standby_connections_used_total')
+                return standby
+            ssl_sock.close()
+        return super(GatewayConnection, self)._open()
+
+    @staticmethod
+    def _is_standby_usable(ssl_sock):
+        rlist, _, _ = select.select([ssl_sock], [], [], 0)
+        if not rlist:
+            return True
+        # a TLS 1.3 session ticket is fine; data or EOF means APNs closed it
+        try:
+            ssl_sock.recv(ERROR_RESPONSE_LENGTH)
+        except ssl.SSLError as err:
+            return err.args[0] == ssl.SSL_ERROR_WANT_READ
+        except socket_error:
+            pass
+        return False
+
+    def warm_up(self):
+        """
+        Connects and opens a standby connection on a background thread, so
+        the next notification does not wait for a TLS handshake (enhanced
+        mode only)
+        """
+        if not self.enhanced:
+            raise ValueError("warm_up() needs an enhanced connection")
+        self._closed = False
+        self._schedule_warm_up()
+
+    def _schedule_warm_up(self):
+        with self._warm_lock:
+            if self._warming or self._closed:
+                return
+            self._warming = True
+        thread = threading.Thread(target=self._warm_up, name='GatewayConnectionWarmer')
+        thread.daemon = True
+        thread.start()
+
+    def _warm_up(self):
+        """Connects, starts reading error-responses, and opens a standby"""
+        try:
+            with self._send_lock:
+                if self._closed:
+                    return
+                self._make_sure_error_response_handler_worker_alive()
+                self._connection()
+            if self._standby is None:
+                standby = self._open()
+                with self._warm_lock:
+                    if self._standby is None and not self._closed:
+                        self._standby, standby = standby, None
+                if standby is not None:
+                    standby[1].close()
+        except (socket_error, SSLError) as e:
+            _logger.warning("warming APNS connection failed: %s: %s", type(e), e)
+        finally:
+            with self._warm_lock:
+                self._warming = False
 
     def _init_error_response_handler_worker(self):
-        self._send_lock = threading.RLock()
         self._error_response_handler_worker = self.ErrorResponseHandlerWorker(apns_connection=self)
         self._error_response_handler_worker.start()
         _logger.debug("initialized error-response handler worker")
 
     def _get_notification(self, token_hex, payload):
         """
-        Takes a token as a hex string and a payload as a Python dict and sends
-        the notification
+        Takes a token as a hex string (or binary) and a payload as a Python
+        dict and sends the notification
         """
-        token_bin = a2b_hex(token_hex)
+        token_bin = _to_bytes(_get_token_bin(token_hex))
         token_length_bin = APNs.packed_ushort_big_endian(len(token_bin))
         payload_json = payload.json()
         payload_length_bin = APNs.packed_ushort_big_endian(len(payload_json))
@@ -518,7 +1870,7 @@ class GatewayConnection(APNsConnection):
         """
         form notification data in an enhanced format
         """
-        token = a2b_hex(token_hex)
+        token = _to_bytes(_get_token_bin(token_hex))
         payload = payload.json()
         fmt = ENHANCED_NOTIFICATION_FORMAT % len(payload)
         notification = pack(fmt, ENHANCED_NOTIFICATION_COMMAND, identifier, expiry,
@@ -527,57 +1879,559 @@ class GatewayConnection(APNsConnection):
 
     def send_notification(self, token_hex, payload, identifier=0, expiry=0):
         """
-        in enhanced mode, send_notification may return error response from APNs if any
+        in enhanced mode, send_notification may return error response from APNs if any.
+        token_hex may also be a binary token, e.g. one taken from a TokenStore.
+        In enhanced mode returns False if the notification could not be
+        written, and True once it is written or queued. In either mode a
+        notification to a token in invalid_tokens is not sent, and False
+        is returned; it is counted in notifications_suppressed_total.
         """
+        if self.invalid_tokens is not None and token_hex in self.invalid_tokens:
+            self.metrics.increment('notifications_suppressed_total')
+            return False
         if self.enhanced:
             self._last_activity_time = time.time()
             message = self._get_enhanced_notification(token_hex, payload,
                                                            identifier, expiry)
 
+            if self.single_writer:
+                self._writer_queue.append((identifier, message))
+                self._wake_writer()
+                return True
+
+            if self.coalesce:
+                with self._send_lock:
+                    self._make_sure_error_response_handler_worker_alive()
+                    self._sent_notifications.append(identifier, message)
+                    self._outbound += message
+                    self._outbound_count += 1
+                    if (len(self._outbound) >= self.coalesce_bytes
+                            or self._outbound_count >= self.coalesce_count):
+                        self._flush_outbound()
+                    elif self._flush_timer is None:
+                        self._flush_timer = threading.Timer(self.coalesce_delay, self.flush)
+                        self._flush_timer.daemon = True
+                        self._flush_timer.start()
+                return True
+
             for i in range(WRITE_RETRY):
                 try:
                     with self._send_lock:
                         self._make_sure_error_response_handler_worker_alive()
-                        self.write(message)
-                        self._sent_notifications.append(dict({'id': identifier, 'message': message}))
-                    break
+                        written = self.write(message)
+                        if written:
+                            self._sent_notifications.append(identifier, message)
+                    if not written:
+                        return False # write() logged and counted the drop
+                    self.metrics.increment('notifications_sent_total')
+                    return True
                 except socket_error as e:
                     delay = 10 + (i * 2)
-                    _logger.exception("sending notification with id:" + str(identifier) +
-                                 " to APNS failed: " + str(type(e)) + ": " + str(e) +
-                                 " in " + str(i+1) + "th attempt, will wait " + str(delay) + " secs for next action")
+                    _logger.exception("sending notification with id:%s to APNS failed: %s: %s"
+                                      " in %dth attempt, will wait %d secs for next action",
+                                      identifier, type(e), e, i + 1, delay)
                     time.sleep(delay) # wait potential error-response to be read
+            return False
 
         else:
-            self.write(self._get_notification(token_hex, payload))
+            if self.write(self._get_notification(token_hex, payload)):
+                self.metrics.increment('notifications_sent_total')
+
+    def enqueue_notification(self, token_hex, payload, identifier=0, expiry=0,
+                             block=True, timeout=None):
+        """
+        Queues a notification for the writer thread. If the queue is full
+        this waits for it to drain, or raises SendQueueFull when block is
+        False or timeout seconds pass first.
+        """
+        if self._send_queue is None:
+            raise ValueError("send queue is not enabled, set send_queue_size")
+        if self.invalid_tokens is not None and token_hex in self.invalid_tokens:
+            self.metrics.increment('notifications_suppressed_total')
+            return
+        message = self._get_enhanced_notification(token_hex, payload,
+                                                  identifier, expiry)
+        self._send_queue.put((identifier, message), block, timeout)
+        self._make_sure_send_queue_writer_alive()
+
+    def _make_sure_send_queue_writer_alive(self):
+        if self._send_queue.claim_writer():
+            self._send_queue_writer = self.SendQueueWriter(apns_connection=self)
+            self._send_queue_writer.start()
+
+    def _write_queued(self, batch):
+        """Writes a batch taken from the send queue, waiting until it can"""
+        data = b''.join(message for _, message in batch)
+        for i in range(WRITE_RETRY):
+            try:
+                with self._send_lock:
+                    self._make_sure_error_response_handler_worker_alive()
+                    if self.write(data):
+                        for identifier, message in batch:
+                            self._sent_notifications.append(identifier, message)
+                        self.metrics.increment('notifications_sent_total', len(batch))
+                        return True
+                # write() waited WAIT_WRITE_TIMEOUT_SEC for the socket
+                if self._send_queue._closed:
+                    _logger.error("dropped %d queued notifications, connection closed"
+                                  " while the socket was not writable", len(batch))
+                    self.metrics.increment('notifications_dropped_total', len(batch))
+                    return False
+                _logger.warning("socket not writable for %d queued notifications"
+                                " in %dth attempt", len(batch), i + 1)
+            except socket_error as e:
+                _logger.exception("writing %d queued notifications to APNS failed: %s: %s"
+                                  " in %dth attempt", len(batch), type(e), e, i + 1)
+                with self._send_lock:
+                    self._disconnect()
+        _logger.error("dropped %d queued notifications after %d attempts",
+                      len(batch), WRITE_RETRY)
+        self.metrics.increment('notifications_dropped_total', len(batch))
+        return False
+
+    def _wake_writer(self):
+        if self._writer_thread is None:
+            self._start_writer()
+        if self._writer_waiting:
+            try:
+                self._writer_wakeup[1].send(b'\0')
+            except socket_error: # full, so the writer wakes anyway
+                pass
+
+    def _start_writer(self, writer=None):
+        """
+        Starts a writer thread unless one is running, or lets the exiting
+        writer carry on. Returns True if writer should carry on.
+        """
+        with self._writer_lock:
+            if self._writer_thread is not None:
+                return False
+            if writer is None:
+                if self._writer_wakeup is None:
+                    self._writer_wakeup = socketpair()
+                    for sock in self._writer_wakeup:
+                        sock.setblocking(False)
+                writer = self.SingleWriter(apns_connection=self)
+                writer.start()
+            self._writer_thread = writer
+            return True
+
+    def _take_writer_batch(self):
+        batch = []
+        queue = self._writer_queue
+        while queue and len(batch) < SEND_QUEUE_BATCH:
+            identifier, message = queue.popleft()
+            if identifier is None: # a Frame
+                batch.extend(message.get_item_messages())
+            else:
+                batch.append((identifier, message))
+        return batch
+
+    def _write_batch(self, batch):
+        """Writes a batch on the writer thread, keeping it for resending"""
+        self._last_activity_time = time.time()
+        for identifier, message in batch:
+            self._sent_notifications.append(identifier, message)
+        data = b''.join(message for _, message in batch)
+        for i in range(WRITE_RETRY):
+            try:
+                if self.write(data):
+                    self.metrics.increment('notifications_sent_total', len(batch))
+                    return
+                # write() logged it; APNs may have stopped reading after an error
+                _logger.warning("writing %d notifications to APNS failed, the socket was"
+                                " not writable in %dth attempt", len(batch), i + 1)
+            except socket_error as e:
+                _logger.exception("writing %d notifications to APNS failed: %s: %s"
+                                  " in %dth attempt", len(batch), type(e), e, i + 1)
+            if self._read_pending_error_response():
+                return # the batch was resent after the failed notification
+            self._disconnect()
+        _logger.error("dropped %d notifications after %d attempts", len(batch), WRITE_RETRY)
+        self.metrics.increment('notifications_dropped_total', len(batch))
+
+    def _read_pending_error_response(self):
+        """Reads an error-response if one is waiting, returns True if so"""
+        if not self.connection_alive:
+            return False
+        try:
+            rlist, _, _ = select.select([self._ssl], [], [], 0)
+            if rlist:
+                self._read_error_response()
+                return True
+        except socket_error as e:
+            _logger.warning("reading APNS error-response failed: %s: %s", type(e), e)
+            self._disconnect()
+        return False
 
     def _make_sure_error_response_handler_worker_alive(self):
+        if self._reactor:
+            # a resend handed off by the reactor goes before anything new
+            self._run_pending_resend()
+            # connecting registers the connection with the reactor
+            self._connection()
+            return
         if (not self._error_response_handler_worker
             or not self._error_response_handler_worker.is_alive()):
+            # start() returns once the thread is running
             self._init_error_response_handler_worker()
-            TIMEOUT_SEC = 10
-            for _ in range(TIMEOUT_SEC):
-                if self._error_response_handler_worker.is_alive():
-                    _logger.debug("error response handler worker is running")
-                    return
-                time.sleep(1)
-            _logger.warning("error response handler worker is not started after %s secs" % TIMEOUT_SEC)
 
     def send_notification_multiple(self, frame):
-        self._sent_notifications += frame.get_notifications(self)
-        return self.write(frame.get_frame())
+        if not self.enhanced:
+            return self._write_frame(frame)
+        self._last_activity_time = time.time()
+        if self.single_writer:
+            self._writer_queue.append((None, frame))
+            self._wake_writer()
+            return True
+        with self._send_lock:
+            self._make_sure_error_response_handler_worker_alive()
+            if self.coalesce:
+                self._flush_outbound() # keep the resend window in write order
+            return self._write_frame(frame)
+
+    def _write_frame(self, frame):
+        for identifier, message in frame.get_item_messages():
+            self._sent_notifications.append(identifier, message)
+        result = None
+        written = 0
+        for data in frame.get_frames():
+            result = self.write(data)
+            if result is False: # write() logged and counted the drop
+                break
+            written += len(data)
+        # the items that start within the bytes written
+        sent = bisect.bisect_left(frame._item_offsets, written)
+        if sent:
+            self.metrics.increment('notifications_sent_total', sent)
+        return result
+
+    def send_notifications(self, notifications, chunk_size=SEND_NOTIFICATIONS_CHUNK,
+                           linger=BROADCAST_LINGER_SEC):
+        """
+        Sends (token, payload, identifier, expiry, priority) tuples taken
+        lazily from notifications, e.g. a generator over a database cursor.
+        Every chunk_size notifications are packed into a Frame and written
+        at once. Returns a SendSummary; in enhanced mode it waits linger
+        secs after the last write for error-responses, and counts each one
+        reported as failed, with the tokens reported invalid. Notifications
+        to tokens in invalid_tokens are counted as suppressed.
+        """
+        summary = SendSummary()
+        resent_before = self._resent_count
+        if self.invalid_tokens is not None:
+            notifications = self._iter_valid(notifications, summary)
+        self._summaries.append(summary)
+        try:
+            for frame in self._iter_frames(notifications, chunk_size):
+                count = len(frame.notification_data)
+                try:
+                    if self.send_notification_multiple(frame) is False:
+                        summary.failed += count # the socket never became writable
+                    else:
+                        summary.sent += count
+                except socket_error as e:
+                    _logger.exception("writing %d notifications to APNS failed: %s: %s",
+                                      count, type(e), e)
+                    summary.failed += count
+                    if self.enhanced:
+                        with self._send_lock:
+                            self._disconnect()
+                    else:
+                        self._disconnect()
+            if self.enhanced and summary.sent and linger:
+                time.sleep(linger)
+        finally:
+            self._summaries.remove(summary)
+        summary.resent = self._resent_count - resent_before
+        return summary
+
+    def _iter_valid(self, notifications, summary):
+        invalid_tokens = self.invalid_tokens
+        for notification in notifications:
+            if notification[0] in invalid_tokens:
+                summary.suppressed += 1
+                self.metrics.increment('notifications_suppressed_total')
+            else:
+                yield notification
+
+    @staticmethod
+    def _iter_frames(notifications, chunk_size):
+        notifications = iter(notifications)
+        while True:
+            frame = Frame()
+            for token, payload, identifier, expiry, priority in itertools.islice(
+                    notifications, chunk_size):
+                frame.add_item(token, payload, identifier, expiry, priority)
+            if not frame.notification_data:
+                return
+            yield frame
 
     def register_response_listener(self, response_listener):
         self._response_listener = response_listener
 
+    def flush(self, timeout=None):
+        """
+        Writes any notifications held back by coalescing, and waits up to
+        timeout seconds for the send queue to be written. Returns False if
+        the send queue was not drained in time.
+        """
+        if self.coalesce:
+            with self._send_lock:
+                self._flush_outbound()
+        if self._send_queue is not None:
+            return self._send_queue.join(timeout)
+        if self.single_writer:
+            deadline = None if timeout is None else time.time() + timeout
+            with self._writer_idle:
+                while self._writer_queue or self._writer_busy:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._writer_idle.wait(remaining)
+        return True
+
+    def _flush_outbound(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if not self._outbound:
+            return
+        data = self._outbound
+        count = self._outbound_count
+        self._outbound = bytearray()
+        self._outbound_count = 0
+        try:
+            if self.write(data):
+                self.metrics.increment('notifications_sent_total', count)
+            else:
+                # they stay in the sent buffer, like after a socket error
+                _logger.error("dropped %d coalesced notifications, the socket was not writable",
+                              count)
+                self.metrics.increment('notifications_dropped_total', count)
+        except socket_error as e:
+            # the notifications stay in the sent buffer, so they are resent
+            # if APNs reports an error for an earlier one
+            _logger.exception("writing %d coalesced notifications to APNS failed: %s: %s",
+                              count, type(e), e)
+            self.metrics.increment('notifications_dropped_total', count)
+
+    def _discard_outbound(self):
+        # called before a resend, which covers everything still buffered
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        self._outbound = bytearray()
+        self._outbound_count = 0
+
     def force_close(self):
+        with self._warm_lock:
+            self._closed = True
+            standby, self._standby = self._standby, None
+        if standby is not None:
+            standby[1].close()
+        if self.coalesce:
+            with self._send_lock:
+                self._flush_outbound()
+        if self._send_queue is not None:
+            # the writer drains what is queued, then exits
+            self._send_queue.close()
+        if self.single_writer:
+            self._writer_closed = True
+            if self._writer_thread is not None:
+                self._wake_writer()
+        if self._reactor:
+            with self._send_lock:
+                self._disconnect()
         if self._error_response_handler_worker:
             self._error_response_handler_worker.close()
 
     def _is_idle_timeout(self):
         TIMEOUT_IDLE = 30
+        if self.warm and not self._closed:
+            return False # keepalive holds idle warm connections open
         return (time.time() - self._last_activity_time) >= TIMEOUT_IDLE
 
+    def _read_error_response(self):
+        """
+        Reads an error-response once the socket is readable, then
+        reconnects and resends the notifications sent after the failed one
+        """
+        with self._send_lock:
+            if not self.connection_alive: # closed while waiting for the lock
+                return
+            try:
+                buff = self.read(ERROR_RESPONSE_LENGTH)
+            except ssl.SSLError as err:
+                if err.args[0] == ssl.SSL_ERROR_WANT_READ: # only part of a TLS record arrived
+                    return
+                raise
+            if len(buff) == ERROR_RESPONSE_LENGTH:
+                command, status, identifier = unpack(ERROR_RESPONSE_FORMAT, buff)
+                if 8 == command: # there is error response from APNS
+                    error_response = (status, identifier)
+                    if self.metrics.enabled:
+                        self.metrics.increment('error_responses_total', labels={'status': status})
+                        sent_time = self._sent_notifications.sent_time(identifier)
+                        if sent_time is not None:
+                            self.metrics.observe('error_response_turnaround_seconds',
+                                                 time.time() - sent_time)
+                    if self._response_listener:
+                        self._response_listener(Util.convert_error_response_to_dict(error_response))
+                    if self._summaries or self.invalid_tokens is not None:
+                        self._record_error_response(status, identifier)
+                    _logger.info("got error-response from APNS: %s", error_response)
+                    self._disconnect()
+                    if self._reactor:
+                        self._schedule_resend(identifier)
+                    else:
+                        self._resend_notifications_by_id(identifier)
+            if len(buff) == 0:
+                _logger.warning("read socket got 0 bytes data") #DEBUG
+                self._disconnect()
+
+    def _record_error_response(self, status, identifier):
+        token = None
+        if status == 8:
+            message = self._sent_notifications.get(identifier)
+            if message is not None:
+                token_bin = _get_message_token(message)
+                if self.invalid_tokens is not None:
+                    self.invalid_tokens.add(token_bin)
+                token = b2a_hex(token_bin)
+        for summary in self._summaries:
+            # it was counted as sent when written
+            if summary.sent:
+                summary.sent -= 1
+            summary.failed += 1
+            if token is not None:
+                summary.invalid_tokens.append(token)
+
+    def _schedule_resend(self, failed_identifier):
+        """
+        Hands the resend after an error-response off to a thread of its
+        own, so the reactor thread only reads. Until it runs, the next send
+        on this connection runs it first instead. Called with _send_lock
+        held.
+        """
+        if self._pending_resend is not None:
+            return # the earlier resend covers this one
+        self._pending_resend = failed_identifier
+        resender = threading.Thread(target=self._resend_pending, name='ResendWorker')
+        resender.daemon = True
+        resender.start()
+
+    def _resend_pending(self):
+        with self._send_lock:
+            self._run_pending_resend()
+
+    def _run_pending_resend(self):
+        # called with _send_lock held
+        failed_identifier = self._pending_resend
+        if failed_identifier is not None:
+            self._pending_resend = None
+            self._resend_notifications_by_id(failed_identifier)
+
+    def _resend_notifications_by_id(self, failed_identifier):
+        sent_notifications = self._sent_notifications
+        #pop-out success notifications till failed one
+        if not sent_notifications.drop_through(failed_identifier):
+            _logger.warning("notification with id:%s is no longer buffered, nothing resent", failed_identifier)
+            return
+        self._discard_outbound()
+        _logger.info("resending %s notifications to APNS", len(sent_notifications)) #DEBUG
+        self.metrics.observe('resend_batch_size', len(sent_notifications))
+        for identifier, message in sent_notifications:
+            _logger.debug("resending notification with id:%s to APNS", identifier) #DEBUG
+            try:
+                self.write(message)
+            except socket_error as e:
+                _logger.exception("resending notification with id:%s failed: %s: %s", identifier, type(e), e) #DEBUG
+                break
+            self._resent_count += 1
+            self.metrics.increment('notifications_resent_total')
+            time.sleep(DELAY_RESEND_SEC) #DEBUG
+
+    class SendQueueWriter(threading.Thread):
+        def __init__(self, apns_connection):
+            threading.Thread.__init__(self, name=self.__class__.__name__)
+            self._apns_connection = apns_connection
+
+        def run(self):
+            send_queue = self._apns_connection._send_queue
+            TIMEOUT_IDLE = 30
+            idle_since = time.time()
+            while True:
+                batch = send_queue.get_batch(SEND_QUEUE_BATCH, timeout=1.0)
+                if not batch:
+                    if ((send_queue._closed or time.time() - idle_since >= TIMEOUT_IDLE)
+                            and send_queue.release_writer()):
+                        break
+                    continue
+                self._apns_connection._write_queued(batch)
+                send_queue.task_done(len(batch))
+                idle_since = time.time()
+            _logger.debug("send queue writer closed") #DEBUG
+
+    class SingleWriter(threading.Thread):
+        """
+        Owns the socket of a single_writer connection: writes what producers
+        queue, reads error-responses and resends
+        """
+        def __init__(self, apns_connection):
+            threading.Thread.__init__(self, name=self.__class__.__name__)
+            self.daemon = True
+            self._apns_connection = apns_connection
+
+        def run(self):
+            connection = self._apns_connection
+            queue = connection._writer_queue
+            wakeup = connection._writer_wakeup[0]
+            while True:
+                while queue:
+                    connection._writer_busy = True
+                    connection._write_batch(connection._take_writer_batch())
+                    # answer an error-response before writing more
+                    connection._read_pending_error_response()
+                with connection._writer_idle:
+                    connection._writer_busy = False
+                    connection._writer_idle.notify_all()
+                if connection._writer_closed or connection._is_idle_timeout():
+                    # while this thread still owns the connection, as the
+                    # next writer may connect as soon as it is released
+                    connection._disconnect()
+                    with connection._writer_lock:
+                        connection._writer_thread = None
+                    # a producer may have queued after the loop above
+                    if queue and connection._start_writer(self):
+                        continue
+                    break
+
+                connection._writer_waiting = True
+                if queue:
+                    connection._writer_waiting = False
+                    continue
+                readers = [wakeup]
+                if connection.connection_alive:
+                    readers.append(connection._ssl)
+                try:
+                    rlist, _, _ = select.select(readers, [], [], WAIT_READ_TIMEOUT_SEC)
+                except (socket_error, ValueError) as e: # closed under us
+                    _logger.debug("selecting on APNS connection failed: %s", e)
+                    rlist = []
+                    connection._disconnect()
+                connection._writer_waiting = False
+                if wakeup in rlist:
+                    try:
+                        while wakeup.recv(4096):
+                            pass
+                    except socket_error:
+                        pass
+                if connection.connection_alive and connection._ssl in rlist:
+                    connection._read_pending_error_response()
+
+            _logger.debug("single writer closed")
+
     class ErrorResponseHandlerWorker(threading.Thread):
         def __init__(self, apns_connection):
             threading.Thread.__init__(self, name=self.__class__.__name__)
@@ -603,25 +2457,13 @@ class GatewayConnection(APNsConnection):
                     continue
 
                 try:
-                    rlist, _, _ = select.select([self._apns_connection._connection()], [], [], WAIT_READ_TIMEOUT_SEC)
+                    # the socket may be closed under us, but never reopen it here
+                    rlist, _, _ = select.select([self._apns_connection._ssl], [], [], WAIT_READ_TIMEOUT_SEC)
 
                     if len(rlist) > 0: # there's some data from APNs
-                        with self._apns_connection._send_lock:
-                            buff = self._apns_connection.read(ERROR_RESPONSE_LENGTH)
-                            if len(buff) == ERROR_RESPONSE_LENGTH:
-                                command, status, identifier = unpack(ERROR_RESPONSE_FORMAT, buff)
-                                if 8 == command: # there is error response from APNS
-                                    error_response = (status, identifier)
-                                    if self._apns_connection._response_listener:
-                                        self._apns_connection._response_listener(Util.convert_error_response_to_dict(error_response))
-                                    _logger.info("got error-response from APNS:" + str(error_response))
-                                    self._apns_connection._disconnect()
-                                    self._resend_notifications_by_id(identifier)
-                            if len(buff) == 0:
-                                _logger.warning("read socket got 0 bytes data") #DEBUG
-                                self._apns_connection._disconnect()
+                        self._apns_connection._read_error_response()
 
-                except socket_error as e: # APNS close connection arbitrarily
+                except (socket_error, ValueError) as e: # APNS close connection arbitrarily
                     _logger.exception("exception occur when reading APNS error-response: " + str(type(e)) + ": " + str(e)) #DEBUG
                     self._apns_connection._disconnect()
                     continue
@@ -632,22 +2474,1099 @@ class GatewayConnection(APNsConnection):
             _logger.debug("error-response handler worker closed") #DEBUG
 
         def _resend_notifications_by_id(self, failed_identifier):
-            fail_idx = Util.getListIndexFromID(self._apns_connection._sent_notifications, failed_identifier)
-            #pop-out success notifications till failed one
-            self._resend_notification_by_range(fail_idx+1, len(self._apns_connection._sent_notifications))
-            return
+            self._apns_connection._resend_notifications_by_id(failed_identifier)
+
+class ErrorResponseReactor(threading.Thread):
+    """
+    A single thread that reads error-responses for any number of enhanced
+    GatewayConnections, using the selectors module.
+
+    Connections register when they connect and unregister when they
+    disconnect; the changes are queued and the thread is woken through a
+    socket pair, so closing or reconnecting takes effect immediately.
+    Connections idle for 30 secs are disconnected. Resending after an
+    error-response is handed off to a thread of its own, or to the next
+    send on the connection, so a long resend never holds up reading for
+    the other connections.
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """Returns the process-wide reactor, starting it if needed"""
+        with cls._shared_lock:
+            if cls._shared is None or not cls._shared.is_alive():
+                cls._shared = cls()
+                cls._shared.start()
+            return cls._shared
 
-        def _resend_notification_by_range(self, start_idx, end_idx):
-            self._apns_connection._sent_notifications = collections.deque(itertools.islice(self._apns_connection._sent_notifications, start_idx, end_idx))
-            _logger.info("resending %s notifications to APNS" % len(self._apns_connection._sent_notifications)) #DEBUG
-            for sent_notification in self._apns_connection._sent_notifications:
-                _logger.debug("resending notification with id:" + str(sent_notification['id']) + " to APNS") #DEBUG
+    def __init__(self):
+        threading.Thread.__init__(self, name=self.__class__.__name__)
+        self.daemon = True
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_recv, self._wakeup_send = socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        self._changes = collections.deque()
+        self._registered = {}
+        self._close_signal = False
+
+    def register(self, connection):
+        self._changes.append((True, connection, connection._ssl))
+        self._wakeup()
+
+    def unregister(self, connection):
+        self._changes.append((False, connection, connection._ssl))
+        self._wakeup()
+
+    def close(self):
+        self._close_signal = True
+        self._wakeup()
+
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b'\0')
+        except socket_error: # already full: the reactor is waking up anyway
+            pass
+
+    def _apply_changes(self):
+        while self._changes:
+            add, connection, sock = self._changes.popleft()
+            registered = self._registered.pop(connection, None)
+            if registered is not None:
                 try:
-                    self._apns_connection.write(sent_notification['message'])
-                except socket_error as e:
-                    _logger.exception("resending notification with id:" + str(sent_notification['id']) + " failed: " + str(type(e)) + ": " + str(e)) #DEBUG
-                    break
-                time.sleep(DELAY_RESEND_SEC) #DEBUG
+                    self._selector.unregister(registered)
+                except (KeyError, ValueError):
+                    pass
+            if add and sock is not None:
+                self._selector.register(sock, selectors.EVENT_READ, connection)
+                self._registered[connection] = sock
+
+    def _select_timeout(self):
+        timeout = WAIT_READ_TIMEOUT_SEC
+        TIMEOUT_IDLE = 30
+        now = time.time()
+        for connection in self._registered:
+            idle_at = connection._last_activity_time + TIMEOUT_IDLE
+            timeout = min(timeout, max(0, idle_at - now))
+        return timeout
+
+    def _close_idle_connections(self):
+        for connection in list(self._registered):
+            if connection._is_idle_timeout():
+                with connection._send_lock:
+                    if connection._is_idle_timeout():
+                        _logger.debug("connection idle after %d secs"
+                                      % (time.time() - connection._last_activity_time))
+                        connection._disconnect()
+
+    def run(self):
+        while not self._close_signal:
+            self._apply_changes()
+            try:
+                events = self._selector.select(self._select_timeout())
+            except (OSError, ValueError) as e: # a socket was closed under us
+                _logger.debug("selecting error-responses failed: %s", e)
+                time.sleep(0.1)
+                continue
+            for key, _ in events:
+                connection = key.data
+                if connection is None:
+                    try:
+                        while self._wakeup_recv.recv(4096):
+                            pass
+                    except socket_error:
+                        pass
+                    continue
+                if self._registered.get(connection) is not key.fileobj:
+                    continue # disconnected since select returned
+                try:
+                    connection._read_error_response()
+                except socket_error as e: # APNS close connection arbitrarily
+                    _logger.exception("exception occur when reading APNS error-response: %s: %s", type(e), e)
+                    connection._disconnect()
+            self._close_idle_connections()
+
+        for connection in list(self._registered):
+            connection._disconnect()
+        self._selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+        _logger.debug("error-response reactor closed")
+
+class GatewayConnectionPool(object):
+    """
+    A pool of GatewayConnections to the APNs gateway sharing one certificate.
+
+    Each send is dispatched to the connection with the fewest sends in
+    progress, so a connection blocked on a full socket is skipped. Ties are
+    broken round-robin. Every connection keeps its own resend buffer and
+    error-response handler. With more threads than connections two sends
+    may pick the same connection; they take turns writing to it.
+    """
+    def __init__(self, size=4, use_sandbox=False, **kwargs):
+        super(GatewayConnectionPool, self).__init__()
+        self.connections = [GatewayConnection(use_sandbox=use_sandbox, **kwargs)
+                            for _ in range(size)]
+        # enhanced connections lock their own writes, simple format ones do not
+        self._write_locks = [threading.Lock() for _ in range(size)]
+        self._loads = [0] * size
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        with self._lock:
+            size = len(self._loads)
+            index = start = self._next
+            for i in range(1, size):
+                candidate = (start + i) % size
+                if self._loads[candidate] < self._loads[index]:
+                    index = candidate
+            self._loads[index] += 1
+            self._next = (index + 1) % size
+        return index
+
+    def _release(self, index):
+        with self._lock:
+            self._loads[index] -= 1
+
+    def _send(self, method, *args):
+        index = self._acquire()
+        try:
+            connection = self.connections[index]
+            if connection.enhanced:
+                return getattr(connection, method)(*args)
+            with self._write_locks[index]:
+                return getattr(connection, method)(*args)
+        finally:
+            self._release(index)
+
+    def send_notification(self, token_hex, payload, identifier=0, expiry=0):
+        return self._send('send_notification', token_hex, payload, identifier, expiry)
+
+    def send_notification_multiple(self, frame):
+        return self._send('send_notification_multiple', frame)
+
+    def register_response_listener(self, response_listener):
+        for connection in self.connections:
+            connection.register_response_listener(response_listener)
+
+    def force_close(self):
+        for connection in self.connections:
+            if connection.enhanced:
+                connection.force_close()
+
+class GatewayConnectionManager(object):
+    """
+    GatewayConnections for many apps, each with its own certificate,
+    created on first use and keyed by (cert_file, key_file, use_sandbox).
+
+    At most max_connections are kept: getting another one closes the least
+    recently used, and connections not used for idle_timeout secs are closed
+    whenever a connection is got, or by close_idle(). The TLS session of a
+    closed connection is kept, so reopening it resumes the session rather
+    than paying a full handshake, and the SSLContext of a certificate is
+    shared by all its connections.
+
+    Connections are enhanced and use the shared ErrorResponseReactor unless
+    told otherwise, so every connection reads its error-responses on one
+    thread. Other keyword arguments are passed to each GatewayConnection.
+    """
+    def __init__(self, max_connections=MANAGER_MAX_CONNECTIONS, idle_timeout=MANAGER_IDLE_SEC,
+                 max_sessions=MANAGER_MAX_SESSIONS, **kwargs):
+        super(GatewayConnectionManager, self).__init__()
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        kwargs.setdefault('enhanced', True)
+        if kwargs['enhanced']:
+            kwargs.setdefault('reactor', True)
+        self._kwargs = kwargs
+        self._connections = collections.OrderedDict() # least recently used first
+        self._sessions = collections.OrderedDict()
+        self._response_listener = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._connections)
+
+    def _create(self, cert_file, key_file, use_sandbox):
+        connection = GatewayConnection(use_sandbox=use_sandbox, cert_file=cert_file,
+                                       key_file=key_file, **self._kwargs)
+        session = self._sessions.pop((cert_file, key_file, use_sandbox), None)
+        if session is not None:
+            connection._tls_session, connection._tls_session_context = session
+        if self._response_listener is not None and connection.enhanced:
+            listener = self._response_listener
+            key = (cert_file, key_file, use_sandbox)
+            connection.register_response_listener(
+                lambda error_response: listener(key, error_response))
+        return connection
+
+    def get(self, cert_file, key_file=None, use_sandbox=False):
+        """
+        Returns the connection for a certificate, creating it if needed.
+        Get it again for every send rather than holding on to it, as the
+        manager may close it once it is evicted.
+        """
+        key = (cert_file, key_file, bool(use_sandbox))
+        now = time.time()
+        with self._lock:
+            entry = self._connections.pop(key, None)
+            connection = entry[0] if entry else self._create(*key)
+            self._connections[key] = (connection, now)
+            evicted = self._take_evicted(now)
+        self._close(evicted)
+        return connection
+
+    def _take_evicted(self, now):
+        evicted = []
+        connections = self._connections
+        while len(connections) > self.max_connections:
+            evicted.append(connections.popitem(last=False))
+        while connections:
+            key, (connection, used_at) = next(iter(connections.items()))
+            if now - used_at < self.idle_timeout:
+                break
+            evicted.append((key, connections.pop(key)))
+        return evicted
+
+    def _close(self, evicted):
+        for key, (connection, _) in evicted:
+            _logger.debug("closing gateway connection for %s", key[0])
+            if connection.enhanced:
+                connection.force_close()
+            else:
+                connection._disconnect()
+            if connection._tls_session is not None:
+                with self._lock:
+                    self._sessions[key] = (connection._tls_session,
+                                           connection._tls_session_context)
+                    while len(self._sessions) > self.max_sessions:
+                        self._sessions.popitem(last=False)
+
+    def close_idle(self):
+        """Closes the connections not used for idle_timeout secs"""
+        with self._lock:
+            evicted = self._take_evicted(time.time())
+        self._close(evicted)
+
+    def register_response_listener(self, response_listener):
+        """
+        Sets a listener called as response_listener(key, error_response)
+        for the error-responses of every connection, key being
+        (cert_file, key_file, use_sandbox)
+        """
+        with self._lock:
+            self._response_listener = response_listener
+            connections = list(self._connections.items())
+        for key, (connection, _) in connections:
+            if connection.enhanced:
+                connection.register_response_listener(
+                    lambda error_response, key=key: response_listener(key, error_response))
+
+    def force_close(self):
+        with self._lock:
+            evicted = list(self._connections.items())
+            self._connections.clear()
+        self._close(evicted)
+
+class _TokenBucket(object):
+    """Allows rate operations per second, in bursts of up to burst"""
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst if burst is not None else rate))
+        self._tokens = self.burst
+        self._updated = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, n):
+        """Takes up to n tokens, returning how many were taken"""
+        self._refill()
+        taken = min(n, int(self._tokens))
+        self._tokens -= taken
+        return taken
+
+    def wait_time(self):
+        """Seconds until the next token is available"""
+        self._refill()
+        return max(0.0, (1.0 - self._tokens) / self.rate)
+
+class _SchedulerLane(object):
+    """The notifications of one priority, queued per app"""
+    def __init__(self, priority, rate=None):
+        self.priority = priority
+        self.bucket = _TokenBucket(rate) if rate else None
+        self._queues = {}
+        self._credits = {}
+        self.count = 0
+
+    def put(self, app, item):
+        queue = self._queues.get(app)
+        if queue is None:
+            queue = self._queues[app] = collections.deque()
+            self._credits[app] = 0
+        queue.append(item)
+        self.count += 1
+
+    def take(self, n, weights):
+        """
+        Takes up to n notifications, interleaving apps by smooth weighted
+        round-robin so each app gets its weight's share of the lane
+        """
+        items = []
+        queues = self._queues
+        credits = self._credits
+        while len(items) < n and self.count:
+            total = 0
+            chosen = None
+            for app, queue in queues.items():
+                if not queue:
+                    continue
+                weight = weights.get(app, 1)
+                credits[app] += weight
+                total += weight
+                if chosen is None or credits[app] > credits[chosen]:
+                    chosen = app
+            credits[chosen] -= total
+            items.append(queues[chosen].popleft())
+            self.count -= 1
+        for app in [app for app, queue in queues.items() if not queue]:
+            del queues[app]
+            del credits[app]
+        return items
+
+class PriorityScheduler(object):
+    """
+    Sends notifications through a GatewayConnection (or pool) from one lane
+    per priority. A dispatcher thread sends frames of up to batch_size
+    notifications, always from the highest priority lane that has any, so
+    time-sensitive notifications overtake queued bulk ones.
+
+    app_weights maps an app, as given to submit(), to its share of a lane
+    (default 1). lane_rates maps a priority to a cap in notifications per
+    second; while the cap holds a lane back, lower lanes are sent.
+
+    dropped counts the notifications of batches that failed, or that the
+    gateway could not write.
+    """
+    def __init__(self, gateway, app_weights=None, lane_rates=None,
+                 batch_size=SCHEDULER_BATCH_SIZE):
+        super(PriorityScheduler, self).__init__()
+        self.gateway = gateway
+        self.app_weights = dict(app_weights or {})
+        self.lane_rates = dict(lane_rates or {})
+        self.batch_size = batch_size
+        self._lanes = []
+        self._pending = 0
+        self.dropped = 0
+        self._closed = False
+        self._condition = threading.Condition(threading.Lock())
+        self._dispatcher = None
+
+    def __len__(self):
+        return self._pending
+
+    def _lane(self, priority):
+        for lane in self._lanes:
+            if lane.priority == priority:
+                return lane
+        lane = _SchedulerLane(priority, self.lane_rates.get(priority))
+        self._lanes.append(lane)
+        self._lanes.sort(key=lambda lane: -lane.priority)
+        return lane
+
+    def submit(self, token_hex, payload, identifier=0, expiry=0,
+               priority=PRIORITY_IMMEDIATE, app=None):
+        with self._condition:
+            if self._closed:
+                raise ValueError("scheduler is closed")
+            self._lane(priority).put(app, (token_hex, payload, identifier, expiry))
+            self._pending += 1
+            self._condition.notify_all()
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch,
+                                                    name='PrioritySchedulerDispatcher')
+                self._dispatcher.daemon = True
+                self._dispatcher.start()
+
+    def _next_batch(self):
+        """
+        Returns (priority, items, None), or (None, None, wait) where wait is
+        the secs until a rate capped lane may send, or None
+        """
+        wait = None
+        for lane in self._lanes:
+            if not lane.count:
+                continue
+            n = min(self.batch_size, lane.count)
+            if lane.bucket is not None:
+                n = lane.bucket.take(n)
+                if not n:
+                    lane_wait = lane.bucket.wait_time()
+                    wait = lane_wait if wait is None else min(wait, lane_wait)
+                    continue
+            return lane.priority, lane.take(n, self.app_weights), None
+        return None, None, wait
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                while True:
+                    priority, items, wait = self._next_batch()
+                    if items:
+                        break
+                    if self._closed and not self._pending:
+                        _logger.debug("priority scheduler dispatcher closed")
+                        return
+                    self._condition.wait(wait)
+            dropped = len(items)
+            try:
+                frame = Frame()
+                for token_hex, payload, identifier, expiry in items:
+                    frame.add_item(token_hex, payload, identifier, expiry, priority)
+                if self.gateway.send_notification_multiple(frame) is False:
+                    _logger.warning("dropped %d notifications of priority %s, the socket"
+                                    " was not writable", len(items), priority)
+                else:
+                    dropped = 0
+            except Exception as e:
+                # e.g. a malformed token; the dispatcher must keep running
+                _logger.exception("sending %d notifications of priority %s failed: %s: %s",
+                                  len(items), priority, type(e), e)
+            finally:
+                with self._condition:
+                    self.dropped += dropped
+                    self._pending -= len(items)
+                    self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits up to timeout seconds for every submitted notification to be
+        sent. Returns False if some are still queued.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """Stops accepting notifications and sends the ones queued"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        return self.flush(timeout)
+
+class HTTP2Response(object):
+    """
+    The response to one notification sent over HTTP/2. status is the HTTP
+    status, 200 when APNs accepted the notification, and reason the error
+    APNs gave otherwise, e.g. 'BadDeviceToken'. For a 410 timestamp is when
+    the token stopped being valid. status is None if the connection was
+    lost before APNs answered.
+    """
+    def __init__(self, token_hex, identifier):
+        super(HTTP2Response, self).__init__()
+        self.token_hex = token_hex
+        self.identifier = identifier
+        self.apns_id = None
+        self.status = None
+        self.reason = None
+        self.timestamp = None
+        self._done = threading.Event()
+
+    @property
+    def ok(self):
+        return self.status == 200
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Waits up to timeout secs for the response, returns done()"""
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def _complete(self, status, reason=None, apns_id=None, timestamp=None):
+        self.status = status
+        self.reason = reason
+        self.apns_id = apns_id
+        self.timestamp = timestamp
+        self._done.set()
+
+    def __repr__(self):
+        return "HTTP2Response(%r, %r, status=%r, reason=%r)" % (
+            self.token_hex, self.identifier, self.status, self.reason)
+
+class _HTTP2Stream(object):
+    def __init__(self, response, headers, body):
+        self.response = response
+        self.headers = headers
+        self.body = body
+        self.unsent = body
+        self.response_headers = {}
+        self.data = []
+
+class HTTP2GatewayConnection(APNsConnection):
+    """
+    A connection to the APNs HTTP/2 provider API, using the h2 package.
+
+    Notifications are sent as concurrent streams over one TLS connection
+    and each gets its own HTTP2Response, so nothing has to be resent after
+    an error. One I/O thread owns the socket: submit() queues a
+    notification and returns its response, which completes when APNs
+    answers. Streams APNs had not processed when it sent a GOAWAY are sent
+    again on a new connection.
+
+    Authenticate with cert_file/key_file, or pass auth_token, a signed
+    provider token (JWT), to send as a bearer token. topic is the default
+    apns-topic, usually the app's bundle id.
+    """
+    def __init__(self, use_sandbox=False, topic=None, auth_token=None, **kwargs):
+        if h2 is None:
+            raise ImportError("HTTP2GatewayConnection needs the h2 package")
+        kwargs['enhanced'] = True # non-blocking socket
+        super(HTTP2GatewayConnection, self).__init__(**kwargs)
+        self.server = (
+            'api.push.apple.com',
+            'api.sandbox.push.apple.com')[use_sandbox]
+        self.port = 443
+        self.topic = topic
+        self.auth_token = auth_token
+        self._h2 = None
+        self._goaway = False
+        self._settings_received = False
+        self._pending = collections.deque()
+        self._streams = {}
+        self._blocked = collections.deque()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = None
+        self._last_activity_time = time.time()
+        self._wakeup_recv, self._wakeup_send = socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+
+    def _ssl_context(self):
+        return _get_ssl_context(self.cert_file, self.key_file, ['h2'])
+
+    def _connect(self):
+        super(HTTP2GatewayConnection, self)._connect()
+        if self._ssl.selected_alpn_protocol() != 'h2':
+            self._disconnect()
+            raise SSLError("%s:%s did not agree to HTTP/2" % (self.server, self.port))
+        # the headers are built by submit(), so skip h2's per-stream checks
+        config = h2.config.H2Configuration(client_side=True, header_encoding='utf-8',
+                                           validate_outbound_headers=False,
+                                           normalize_outbound_headers=False)
+        self._h2 = h2.connection.H2Connection(config=config)
+        self._h2.initiate_connection()
+        self._goaway = False
+        self._settings_received = False
+        self._blocked.clear() # stream ids start again on a new connection
+        self._flush()
+
+    def _disconnect(self):
+        if self.connection_alive and self._h2 is not None and not self._goaway:
+            try:
+                self._h2.close_connection()
+                self._flush()
+            except (socket_error, h2.exceptions.ProtocolError):
+                pass
+        self._h2 = None
+        super(HTTP2GatewayConnection, self)._disconnect()
+
+    def submit(self, token_hex, payload, identifier=0, expiry=0,
+               priority=PRIORITY_IMMEDIATE, topic=None, collapse_id=None,
+               push_type=None, apns_id=None):
+        """
+        Queues a notification and returns its HTTP2Response without
+        waiting for it. push_type defaults to 'alert' for payloads with an
+        alert, sound or badge and 'background' otherwise.
+        """
+        token_hex = b2a_hex(_get_token_bin(token_hex)).decode('ascii')
+        if push_type is None:
+            push_type = ('background', 'alert')[bool(
+                payload.alert or payload.sound or payload.badge is not None)]
+        headers = [
+            (':method', 'POST'),
+            (':scheme', 'https'),
+            (':path', '/3/device/' + token_hex),
+            (':authority', self.server),
+            ('apns-push-type', push_type),
+            ('apns-priority', str(priority)),
+            ('apns-expiration', str(expiry)),
+        ]
+        topic = topic or self.topic
+        if topic:
+            headers.append(('apns-topic', topic))
+        if collapse_id:
+            headers.append(('apns-collapse-id', collapse_id))
+        if apns_id:
+            headers.append(('apns-id', apns_id))
+        if self.auth_token:
+            headers.append(('authorization', 'bearer ' + self.auth_token))
+        response = HTTP2Response(token_hex, identifier)
+        with self._lock:
+            if self._closed:
+                raise ValueError("connection is closed")
+            self._pending.append((response, headers, payload.json()))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.__class__.__name__)
+                self._thread.daemon = True
+                self._thread.start()
+        self._wake()
+        return response
+
+    def send_notification(self, token_hex, payload, identifier=0, expiry=0, **kwargs):
+        """
+        Sends a notification and waits for its HTTP2Response. Takes the
+        keyword arguments of submit().
+        """
+        response = self.submit(token_hex, payload, identifier, expiry, **kwargs)
+        response.wait(self.timeout)
+        return response
+
+    def send_notification_multiple(self, frame, **kwargs):
+        """
+        Sends the notifications of a Frame as concurrent streams and
+        returns their HTTP2Responses, once all have completed
+        """
+        responses = [self.submit(item['token'], item['payload'], item['identifier'],
+                                 item['expiry'], item['priority'], **kwargs)
+                     for item in frame.notification_data]
+        for response in responses:
+            response.wait(self.timeout)
+        return responses
+
+    def close(self, timeout=None):
+        """
+        Stops accepting notifications and waits up to timeout secs for the
+        ones submitted to complete
+        """
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        self._wake()
+        if thread is not None:
+            thread.join(timeout)
+
+    def _wake(self):
+        try:
+            self._wakeup_send.send(b'\0')
+        except socket_error: # the socket buffer is full, so it will wake anyway
+            pass
+
+    def _flush(self):
+        data = self._h2.data_to_send()
+        if data:
+            self._sendall(data)
+
+    def _send_body(self, stream_id, stream):
+        """Sends as much of the body as flow control allows, returns True when done"""
+        h2_connection = self._h2
+        while stream.unsent:
+            # the smaller of the stream's and the connection's window
+            size = min(len(stream.unsent), h2_connection.local_flow_control_window(stream_id),
+                       h2_connection.max_outbound_frame_size)
+            if size <= 0:
+                return False # until APNs sends a WINDOW_UPDATE
+            data, stream.unsent = stream.unsent[:size], stream.unsent[size:]
+            h2_connection.send_data(stream_id, data, end_stream=not stream.unsent)
+        return True
+
+    def _start_streams(self):
+        h2_connection = self._h2
+        blocked = self._blocked
+        while blocked:
+            stream = self._streams.get(blocked[0])
+            if stream is not None and not self._send_body(blocked[0], stream):
+                return
+            blocked.popleft()
+        pending = self._pending
+        # the stream limit is unknown until the SETTINGS from APNs arrive
+        while pending and self._settings_received and not self._goaway:
+            # h2's open_outbound_streams counts every stream each time
+            if len(self._streams) >= h2_connection.remote_settings.max_concurrent_streams:
+                break
+            if h2_connection.outbound_flow_control_window <= 0:
+                break # until APNs sends a WINDOW_UPDATE
+            response, headers, body = pending.popleft()
+            stream_id = h2_connection.get_next_available_stream_id()
+            h2_connection.send_headers(stream_id, headers)
+            stream = self._streams[stream_id] = _HTTP2Stream(response, headers, body)
+            self._last_activity_time = time.time()
+            if not self._send_body(stream_id, stream):
+                blocked.append(stream_id)
+                break
+
+    def _receive(self):
+        try:
+            data = self._ssl.recv(HTTP2_READ_SIZE)
+        except ssl.SSLError as err:
+            if err.args[0] == ssl.SSL_ERROR_WANT_READ:
+                return
+            raise
+        if not data:
+            raise socket_error("APNs closed the connection")
+        for event in self._h2.receive_data(data):
+            if isinstance(event, h2.events.DataReceived):
+                # counts against the connection window even for an unknown stream
+                self._h2.acknowledge_received_data(event.flow_controlled_length,
+                                                   event.stream_id)
+            stream_id = getattr(event, 'stream_id', 0)
+            if stream_id:
+                # e.g. a stream already completed as reset or lost
+                stream = self._streams.get(stream_id)
+                if stream is None:
+                    _logger.debug("ignoring %s for unknown stream %s",
+                                  type(event).__name__, stream_id)
+                elif isinstance(event, h2.events.ResponseReceived):
+                    stream.response_headers = dict(event.headers)
+                elif isinstance(event, h2.events.DataReceived):
+                    stream.data.append(event.data)
+                elif isinstance(event, h2.events.StreamEnded):
+                    self._complete_stream(stream_id)
+                elif isinstance(event, h2.events.StreamReset):
+                    del self._streams[stream_id]
+                    stream.response._complete(None, 'StreamReset')
+            elif isinstance(event, h2.events.RemoteSettingsChanged):
+                self._settings_received = True
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self._terminated(event.last_stream_id, event.additional_data)
+
+    def _complete_stream(self, stream_id):
+        stream = self._streams.pop(stream_id)
+        status = int(stream.response_headers.get(':status', 0))
+        reason = timestamp = None
+        if status != 200 and stream.data:
+            try:
+                body = json.loads(b''.join(stream.data).decode('utf-8'))
+            except ValueError:
+                body = {}
+            reason = body.get('reason')
+            if body.get('timestamp'):
+                timestamp = datetime.utcfromtimestamp(body['timestamp'] / 1000.0)
+        if self.metrics.enabled:
+            self.metrics.increment('http2_responses_total', labels={'status': status})
+            if status == 200:
+                self.metrics.increment('notifications_sent_total')
+        stream.response._complete(status, reason, stream.response_headers.get('apns-id'),
+                                  timestamp)
+
+    def _terminated(self, last_stream_id, additional_data):
+        _logger.info("APNS sent GOAWAY after stream %s: %s", last_stream_id, additional_data)
+        self._goaway = True
+        # streams APNs did not process go out again on the next connection
+        retry = sorted(stream_id for stream_id in self._streams if stream_id > last_stream_id)
+        for stream_id in reversed(retry):
+            stream = self._streams.pop(stream_id)
+            self._pending.appendleft((stream.response, stream.headers, stream.body))
+
+    def _connection_lost(self, error):
+        if self._goaway and not self._streams: # APNs closing after a GOAWAY
+            _logger.debug("HTTP/2 connection to APNS closed: %s", error)
+        else:
+            _logger.warning("HTTP/2 connection to APNS lost: %s: %s", type(error), error)
+        for stream in self._streams.values():
+            stream.response._complete(None, 'ConnectionLost')
+        self._streams.clear()
+        self._blocked.clear()
+        self._goaway = True # nothing more can be sent on it
+        self._disconnect()
+
+    def _fail_pending(self, reason):
+        while self._pending:
+            response, _, _ = self._pending.popleft()
+            response._complete(None, reason)
+
+    def _is_idle_timeout(self):
+        TIMEOUT_IDLE = 30
+        return (time.time() - self._last_activity_time) >= TIMEOUT_IDLE
+
+    def _run(self):
+        while not (self._closed and not self._pending and not self._streams):
+            if self._pending and (not self.connection_alive
+                                  or (self._goaway and not self._streams)):
+                self._disconnect()
+                try:
+                    self._connect()
+                except (socket_error, h2.exceptions.ProtocolError) as e:
+                    _logger.warning("connecting to APNS over HTTP/2 failed: %s: %s", type(e), e)
+                    self._fail_pending('ConnectionFailed')
+                    continue
+
+            readers = [self._wakeup_recv]
+            try:
+                if self.connection_alive:
+                    self._start_streams()
+                    self._flush()
+                    readers.append(self._ssl)
+                    if self._ssl.pending():
+                        self._receive()
+                        continue
+                rlist, _, _ = select.select(readers, [], [], WAIT_READ_TIMEOUT_SEC)
+                if self._wakeup_recv in rlist:
+                    try:
+                        while self._wakeup_recv.recv(4096):
+                            pass
+                    except socket_error:
+                        pass
+                if self.connection_alive and self._ssl in rlist:
+                    self._receive()
+                    self._start_streams()
+                    self._flush()
+            except (socket_error, h2.exceptions.ProtocolError) as e:
+                self._connection_lost(e)
+                continue
+
+            if (self.connection_alive and not self._streams and not self._pending
+                    and (self._goaway or self._is_idle_timeout())):
+                self._disconnect()
+        self._disconnect()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+        _logger.debug("HTTP/2 connection I/O thread closed")
+
+class SendSummary(object):
+    """
+    The combined outcome of sending many notifications. sent counts those
+    written that APNs did not report an error for, failed those that could
+    not be written or that it did, so sent + failed + suppressed is the
+    number of notifications given.
+    """
+    def __init__(self, sent=0, failed=0, invalid_tokens=None, resent=0, suppressed=0):
+        super(SendSummary, self).__init__()
+        self.sent = sent
+        self.failed = failed
+        self.invalid_tokens = invalid_tokens if invalid_tokens is not None else []
+        self.resent = resent
+        self.suppressed = suppressed # skipped, being in an InvalidTokenFilter
+
+    def merge(self, other):
+        """Add the counts of another SendSummary to this one"""
+        self.sent += other.sent
+        self.failed += other.failed
+        self.invalid_tokens.extend(other.invalid_tokens)
+        self.resent += other.resent
+        self.suppressed += other.suppressed
+        return self
+
+    def __repr__(self):
+        return "%s(sent=%d, failed=%d, invalid_tokens=%d, resent=%d, suppressed=%d)" % (
+            self.__class__.__name__, self.sent, self.failed,
+            len(self.invalid_tokens), self.resent, self.suppressed)
+
+class Broadcaster(object):
+    """
+    Sends one payload to a very large number of tokens by sharding them
+    across worker processes, each with its own enhanced GatewayConnection.
+
+    Tokens may come from a TokenStore or any iterable: a list, a generator
+    or a file with one hex token per line. They are read lazily in chunks of chunk_size.
+    After each chunk a worker waits linger seconds for error-responses so
+    they can be counted in the summary. Once every chunk is sent, each
+    worker waits until its connection has been quiet for linger seconds,
+    then closes it, so late error-responses and resends are counted too.
+
+    The invalid tokens in the summary are the tokens as given, or hex
+    bytes for a TokenStore.
+
+    Tokens in invalid_tokens, an InvalidTokenFilter, are skipped before
+    they are handed to the workers, and the tokens reported invalid are
+    added to it once the broadcast is done.
+    """
+    def __init__(self, use_sandbox=False, cert_file=None, key_file=None,
+                 processes=None, chunk_size=BROADCAST_CHUNK_SIZE,
+                 linger=BROADCAST_LINGER_SEC, invalid_tokens=None):
+        super(Broadcaster, self).__init__()
+        self.use_sandbox = use_sandbox
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.linger = linger
+        self.invalid_tokens = invalid_tokens
+
+    def send(self, payload, tokens, expiry=0):
+        """Send payload to every token and return a SendSummary"""
+        import multiprocessing
+        summary = SendSummary()
+        suppress = None
+        if self.invalid_tokens is not None:
+            invalid_tokens = self.invalid_tokens
+
+            def suppress(token):
+                if token in invalid_tokens:
+                    summary.suppressed += 1
+                    return True
+                return False
+
+        processes = self.processes or multiprocessing.cpu_count()
+        # makes each worker take exactly one _finish_broadcast_worker task
+        barrier = None
+        if hasattr(multiprocessing, 'Barrier'):
+            barrier = multiprocessing.Barrier(processes)
+        pool = multiprocessing.Pool(
+            processes, _init_broadcast_worker,
+            (self.use_sandbox, self.cert_file, self.key_file, payload,
+             expiry, self.linger, barrier))
+        try:
+            if isinstance(tokens, TokenStore):
+                chunks = _iter_token_store_chunks(tokens, self.chunk_size, suppress)
+            else:
+                chunks = _iter_broadcast_chunks(tokens, self.chunk_size, suppress)
+            for result in pool.imap_unordered(_broadcast_chunk, chunks):
+                summary.merge(result)
+            for result in pool.imap_unordered(_finish_broadcast_worker, range(processes)):
+                summary.merge(result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        if self.invalid_tokens is not None:
+            self.invalid_tokens.update(summary.invalid_tokens)
+        return summary
+
+def _iter_broadcast_chunks(tokens, chunk_size, suppress=None):
+    chunk = []
+    start = 0
+    for token in tokens:
+        token = token.strip()
+        if not token or (suppress is not None and suppress(token)):
+            continue
+        chunk.append(token)
+        if len(chunk) >= chunk_size:
+            yield (start, chunk)
+            start += len(chunk)
+            chunk = []
+    if chunk:
+        yield (start, chunk)
+
+def _iter_token_store_chunks(tokens, chunk_size, suppress=None):
+    start = 0
+    for chunk in tokens.chunks(chunk_size):
+        if suppress is not None:
+            chunk = TokenStore(b''.join(token for token in chunk if not suppress(token)))
+            if not len(chunk):
+                continue
+        yield (start, chunk)
+        start += len(chunk)
+
+_broadcast_state = {}
+
+def _init_broadcast_worker(use_sandbox, cert_file, key_file, payload, expiry, linger,
+                           barrier=None):
+    gateway = GatewayConnection(use_sandbox=use_sandbox, cert_file=cert_file,
+                                key_file=key_file, enhanced=True)
+    _set_broadcast_gateway(gateway, payload, expiry, linger, barrier)
+
+def _set_broadcast_gateway(gateway, payload, expiry, linger, barrier=None):
+    errors = []
+
+    def response_listener(error_response):
+        # called before the resend, while the failed message is still buffered
+        identifier = error_response[ER_IDENTIFER]
+        message = gateway._sent_notifications.get(identifier)
+        token = None
+        if message is not None:
+            token = _get_message_token(message)
+        errors.append((error_response[ER_STATUS], identifier, token))
+
+    gateway.register_response_listener(response_listener)
+    _broadcast_state.update(gateway=gateway, errors=errors, payload=payload,
+                            expiry=expiry, linger=linger, barrier=barrier,
+                            chunk=(0, ()))
+
+def _broadcast_chunk(chunk):
+    start, tokens = chunk
+    gateway = _broadcast_state['gateway']
+    payload = _broadcast_state['payload']
+    expiry = _broadcast_state['expiry']
+    resent_before = gateway._resent_count
+    _broadcast_state['chunk'] = chunk
+
+    summary = SendSummary()
+    for i, token in enumerate(tokens):
+        if gateway.send_notification(token, payload, (start + i) & 0xffffffff, expiry):
+            summary.sent += 1
+        else:
+            summary.failed += 1
+    time.sleep(_broadcast_state['linger'])
+
+    _take_broadcast_errors(summary)
+    summary.resent = gateway._resent_count - resent_before
+    return summary
+
+def _finish_broadcast_worker(_):
+    """
+    Waits for the worker's connection to go quiet, then closes it, and
+    returns what happened since its last chunk
+    """
+    barrier = _broadcast_state['barrier']
+    if barrier is not None:
+        try:
+            barrier.wait(BROADCAST_CLOSE_TIMEOUT_SEC)
+        except threading.BrokenBarrierError:
+            _logger.warning("not every broadcast worker finished within %d secs",
+                            BROADCAST_CLOSE_TIMEOUT_SEC)
+    gateway = _broadcast_state['gateway']
+    errors = _broadcast_state['errors']
+    resent_before = gateway._resent_count
+    while True:
+        seen = (len(errors), gateway._resent_count)
+        time.sleep(_broadcast_state['linger'])
+        # taking the lock waits for a resend in progress
+        with gateway._send_lock:
+            if (len(errors), gateway._resent_count) == seen:
+                gateway.force_close()
+                if gateway.connection_alive:
+                    try:
+                        # wakes the error-response thread from select()
+                        gateway._ssl.shutdown(SHUT_RDWR)
+                    except socket_error:
+                        pass
+                gateway._disconnect()
+                break
+    worker = gateway._error_response_handler_worker
+    if worker is not None and worker.is_alive():
+        worker.join(WAIT_READ_TIMEOUT_SEC)
+
+    summary = SendSummary()
+    _take_broadcast_errors(summary)
+    summary.resent = gateway._resent_count - resent_before
+    return summary
+
+def _take_broadcast_errors(summary):
+    start, tokens = _broadcast_state['chunk']
+    text = bool(len(tokens)) and isinstance(tokens[0], type(u''))
+    errors = _broadcast_state['errors']
+    while errors:
+        status, identifier, token = errors.pop(0)
+        # it was counted as sent when written, perhaps in an earlier chunk's
+        # summary; the merged counts come out right
+        summary.sent -= 1
+        summary.failed += 1
+        if status != 8:
+            continue
+        index = (identifier - start) & 0xffffffff
+        if index < len(tokens) and not isinstance(tokens, TokenStore):
+            summary.invalid_tokens.append(tokens[index]) # as the caller gave it
+        elif token is not None:
+            token = b2a_hex(token)
+            summary.invalid_tokens.append(token.decode('ascii') if text else token)
 
 class Util(object):
     @classmethod
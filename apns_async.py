@@ -0,0 +1,267 @@
+# PyAPNs is distributed under the terms of the MIT license.
+#
+# See the LICENSE file for the complete license details.
+
+"""
+asyncio based connections to the APNs gateway and feedback servers.
+
+This module requires Python 3.7 or later; the classes in ``apns`` remain
+the portable (Python 2 compatible) implementation.
+"""
+
+import asyncio
+import logging
+import time
+from binascii import b2a_hex
+from datetime import datetime
+from struct import unpack
+
+from apns import (GatewayConnection, SentNotificationBuffer, Util, _get_ssl_context,
+                  ERROR_RESPONSE_FORMAT, ERROR_RESPONSE_LENGTH,
+                  WAIT_READ_TIMEOUT_SEC)
+
+_logger = logging.getLogger(__name__)
+
+TIMEOUT_IDLE = 30
+
+
+class AsyncAPNsConnection(object):
+    """
+    A generic asyncio connection class for communicating with the APNs
+    """
+    def __init__(self, cert_file=None, key_file=None, timeout=None):
+        super(AsyncAPNsConnection, self).__init__()
+        self.cert_file = cert_file
+        self.key_file = key_file
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self.connection_alive = False
+
+    def _get_ssl_context(self):
+        return _get_ssl_context(self.cert_file, self.key_file)
+
+    def _open_connection(self):
+        return asyncio.open_connection(self.server, self.port,
+                                       ssl=self._get_ssl_context())
+
+    async def _connect(self):
+        _logger.debug("%s APNS connection establishing...", self.__class__.__name__)
+        self._reader, self._writer = await asyncio.wait_for(
+            self._open_connection(), self.timeout)
+        self.connection_alive = True
+        _logger.debug("%s APNS connection established", self.__class__.__name__)
+
+    def _disconnect(self):
+        """
+        Closes the connection and returns its writer, for the caller to
+        await _wait_closed() on, or None if it was not open
+        """
+        if not self.connection_alive:
+            return None
+        writer = self._writer
+        writer.close()
+        self._reader = self._writer = None
+        self.connection_alive = False
+        _logger.info(" %s APNS connection closed", self.__class__.__name__)
+        return writer
+
+    @staticmethod
+    async def _wait_closed(writer):
+        if writer is None:
+            return
+        try:
+            await writer.wait_closed()
+        except (ConnectionError, OSError) as e: # the peer went first
+            _logger.debug("closing APNS connection: %r", e)
+
+    async def read(self, n=-1):
+        if not self.connection_alive:
+            await self._connect()
+        return await self._reader.read(n)
+
+    async def close(self):
+        await self._wait_closed(self._disconnect())
+
+
+class AsyncFeedbackConnection(AsyncAPNsConnection):
+    """
+    An asyncio connection to the APNs Feedback server
+    """
+    def __init__(self, use_sandbox=False, **kwargs):
+        super(AsyncFeedbackConnection, self).__init__(**kwargs)
+        self.server = (
+            'feedback.push.apple.com',
+            'feedback.sandbox.push.apple.com')[use_sandbox]
+        self.port = 2196
+
+    async def _chunks(self):
+        BUF_SIZE = 4096
+        while True:
+            data = await self.read(BUF_SIZE)
+            yield data
+            if not data:
+                break
+
+    async def items(self):
+        """
+        An asynchronous generator that yields (token_hex, fail_time) pairs
+        retrieved from the APNs feedback server
+        """
+        buff = b''
+        async for chunk in self._chunks():
+            buff += chunk
+
+            if len(buff) < 6:
+                break
+
+            offset = 0
+            while len(buff) - offset > 6:
+                fail_time_unix, token_length = unpack('>IH', buff[offset:offset + 6])
+                bytes_to_read = 6 + token_length
+                if len(buff) - offset < bytes_to_read:
+                    break
+                token = b2a_hex(buff[offset + 6:offset + bytes_to_read])
+                yield (token, datetime.utcfromtimestamp(fail_time_unix))
+                offset += bytes_to_read
+            buff = buff[offset:]
+        await self._wait_closed(self._disconnect())
+
+
+class AsyncGatewayConnection(AsyncAPNsConnection):
+    """
+    An asyncio connection to the APNs gateway server.
+
+    Notifications are always sent in the enhanced format. Error responses
+    are read by a task on the event loop, which reconnects and resends the
+    notifications that followed the failed one, just like
+    GatewayConnection.ErrorResponseHandlerWorker does on a thread.
+    """
+    _get_notification = GatewayConnection._get_notification
+    _get_enhanced_notification = GatewayConnection._get_enhanced_notification
+
+    def __init__(self, use_sandbox=False, **kwargs):
+        super(AsyncGatewayConnection, self).__init__(**kwargs)
+        self.server = (
+            'gateway.push.apple.com',
+            'gateway.sandbox.push.apple.com')[use_sandbox]
+        self.port = 2195
+        self._last_activity_time = time.time()
+        self._connect_lock = None
+        self._send_lock = None
+        self._error_response_task = None
+        self._response_listener = None
+        self._sent_notifications = SentNotificationBuffer()
+
+    async def _connect(self):
+        await super(AsyncGatewayConnection, self)._connect()
+        self._error_response_task = asyncio.ensure_future(
+            self._read_error_responses(self._reader))
+
+    async def _make_sure_connected(self):
+        if self.connection_alive:
+            return
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if not self.connection_alive:
+                await self._connect()
+
+    def _get_send_lock(self):
+        # held while writing, and by a resend from its disconnect on, so
+        # nothing is written between the two or resent out of order
+        if self._send_lock is None:
+            self._send_lock = asyncio.Lock()
+        return self._send_lock
+
+    async def send_notification(self, token_hex, payload, identifier=0, expiry=0):
+        self._last_activity_time = time.time()
+        message = self._get_enhanced_notification(token_hex, payload,
+                                                  identifier, expiry)
+        async with self._get_send_lock():
+            await self._make_sure_connected()
+            writer = self._writer
+            writer.write(message)
+            self._sent_notifications.append(identifier, message)
+        await self._drain(writer)
+
+    async def send_notification_multiple(self, frame):
+        self._last_activity_time = time.time()
+        async with self._get_send_lock():
+            await self._make_sure_connected()
+            writer = self._writer
+            # the transport may hold on to the data, and the caller may
+            # reuse the frame
+            writer.write(bytes(frame.get_frame()))
+            for identifier, message in frame.get_item_messages():
+                self._sent_notifications.append(identifier, message)
+        await self._drain(writer)
+
+    async def _drain(self, writer):
+        try:
+            await writer.drain()
+        except ConnectionError as e:
+            # like GatewayConnection, the notifications stay buffered, so
+            # they are resent if APNs reports an error for an earlier one
+            _logger.warning("writing to APNS failed: %r", e)
+
+    def register_response_listener(self, response_listener):
+        self._response_listener = response_listener
+
+    async def close(self):
+        task = self._error_response_task
+        writer = self._disconnect()
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self._wait_closed(writer)
+
+    def _is_idle_timeout(self):
+        return (time.time() - self._last_activity_time) >= TIMEOUT_IDLE
+
+    async def _read_error_responses(self, reader):
+        while self._reader is reader:
+            try:
+                buff = await asyncio.wait_for(
+                    reader.readexactly(ERROR_RESPONSE_LENGTH), WAIT_READ_TIMEOUT_SEC)
+            except asyncio.TimeoutError:
+                if self._is_idle_timeout():
+                    _logger.debug("connection idle after %d secs",
+                                  time.time() - self._last_activity_time)
+                    await self._wait_closed(self._disconnect())
+                continue
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                if self._reader is reader:
+                    _logger.warning("APNS closed connection: %r", e)
+                    await self._wait_closed(self._disconnect())
+                break
+
+            command, status, identifier = unpack(ERROR_RESPONSE_FORMAT, buff)
+            if command != 8:
+                continue
+            error_response = (status, identifier)
+            if self._response_listener:
+                self._response_listener(Util.convert_error_response_to_dict(error_response))
+            _logger.info("got error-response from APNS: %s", error_response)
+            async with self._get_send_lock():
+                await self._wait_closed(self._disconnect())
+                await self._resend_notifications_by_id(identifier)
+            break
+
+    async def _resend_notifications_by_id(self, failed_identifier):
+        if not self._sent_notifications.drop_through(failed_identifier):
+            _logger.warning("notification with id:%s is no longer buffered, nothing resent",
+                            failed_identifier)
+            return
+        _logger.info("resending %s notifications to APNS", len(self._sent_notifications))
+        if not self._sent_notifications:
+            return
+        await self._make_sure_connected()
+        for _, message in self._sent_notifications:
+            # the transport may hold on to the data, so copy it out of the
+            # buffer's arena
+            self._writer.write(bytes(message))
+        await self._writer.drain()
@@ -0,0 +1,12 @@
+"""
+Benchmarks for PyAPNs.
+
+Run them all and print the results as JSON with::
+
+    python -m benchmarks [--output results.json] [--count N]
+
+``benchmarks.micro`` times the encoding and parsing hot spots in isolation;
+``benchmarks.memory`` measures the memory held per 100k in-flight
+notifications; ``benchmarks.gateway`` measures throughput and per-send
+latency against a local TLS server standing in for the APNs gateway.
+"""
@@ -0,0 +1,41 @@
+import json
+import optparse
+import platform
+import sys
+import time
+
+from benchmarks import gateway, micro
+try:
+    from benchmarks import memory
+except ImportError: # no tracemalloc
+    memory = None
+
+parser = optparse.OptionParser(prog='python -m benchmarks')
+parser.add_option("-o", "--output", dest="output",
+                  help="Write the JSON results to this file instead of stdout")
+parser.add_option("-n", "--count", dest="count", type="int", default=20000,
+                  help="Notifications per end-to-end benchmark")
+parser.add_option("-m", "--micro-number", dest="micro_number", type="int", default=100000,
+                  help="Iterations per microbenchmark")
+parser.add_option("--skip-gateway", action="store_true", dest="skip_gateway", default=False,
+                  help="Only run the microbenchmarks")
+
+options, args = parser.parse_args()
+
+results = {
+    'timestamp': time.time(),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'micro_us_per_call': micro.run(options.micro_number),
+}
+if memory is not None:
+    results['memory_mb_per_100k'] = memory.run()
+if not options.skip_gateway:
+    results['gateway'] = gateway.run(options.count)
+
+output = json.dumps(results, indent=2, sort_keys=True)
+if options.output:
+    with open(options.output, 'w') as f:
+        f.write(output + '\n')
+else:
+    sys.stdout.write(output + '\n')
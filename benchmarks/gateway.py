@@ -0,0 +1,304 @@
+"""
+End-to-end benchmarks against local TLS servers standing in for the APNs
+gateway. The binary protocol server accepts any client, discards what it
+reads and never sends an error-response; the HTTP/2 server answers every
+notification with a 200 unless told otherwise.
+"""
+
+import json
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.settings
+except ImportError:
+    h2 = None
+
+from apns import Frame, GatewayConnection, HTTP2GatewayConnection, Payload
+
+TOKEN_HEX = 'b5bb9d8014a0f9b1d61e21e796d78dccdf1352f23cd32812f4850b878ae4944c'
+FRAME_SIZE = 1000
+
+
+def make_self_signed_cert(directory):
+    """Writes a throwaway self-signed certificate and key with openssl"""
+    cert_file = os.path.join(directory, 'cert.pem')
+    key_file = os.path.join(directory, 'key.pem')
+    subprocess.check_call(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+         '-keyout', key_file, '-out', cert_file, '-days', '1',
+         '-subj', '/CN=localhost'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return cert_file, key_file
+
+
+class LoopbackGateway(object):
+    """A TLS server on 127.0.0.1 that reads and discards everything"""
+
+    def __init__(self, cert_file, key_file):
+        self._context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        self._context.load_cert_chain(cert_file, key_file)
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(('127.0.0.1', 0))
+        self._listener.listen(16)
+        self.address = self._listener.getsockname()
+        self.bytes_received = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        while not self._closed:
+            try:
+                sock, _ = self._listener.accept()
+            except socket.error:
+                break
+            thread = threading.Thread(target=self._drain, args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+    def _drain(self, sock):
+        try:
+            conn = self._context.wrap_socket(sock, server_side=True)
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                self.bytes_received += len(data)
+        except (socket.error, ssl.SSLError):
+            pass
+        finally:
+            sock.close()
+
+    def close(self):
+        self._closed = True
+        self._listener.close()
+
+
+class LoopbackHTTP2Gateway(object):
+    """
+    A TLS server on 127.0.0.1 speaking enough of the APNs HTTP/2 provider
+    API for tests and benchmarks. responder is called with the headers and
+    body of each notification and returns (status, reason); by default
+    every notification gets a 200. With goaway_after set, each connection
+    sends a GOAWAY after answering that many notifications, leaving any
+    later streams unanswered. initial_window_size, if set, is the stream
+    flow control window the server advertises.
+    """
+
+    def __init__(self, cert_file, key_file, responder=None, goaway_after=None,
+                 initial_window_size=None):
+        self._context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        self._context.load_cert_chain(cert_file, key_file)
+        self._context.set_alpn_protocols(['h2'])
+        self._responder = responder or (lambda headers, body: (200, None))
+        self._goaway_after = goaway_after
+        self._initial_window_size = initial_window_size
+        self.requests = []
+        self.connections = 0
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(('127.0.0.1', 0))
+        self._listener.listen(16)
+        self.address = self._listener.getsockname()
+        self._closed = False
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        while not self._closed:
+            try:
+                sock, _ = self._listener.accept()
+            except socket.error:
+                break
+            self.connections += 1
+            thread = threading.Thread(target=self._handle, args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, sock):
+        try:
+            conn = self._context.wrap_socket(sock, server_side=True)
+            config = h2.config.H2Configuration(client_side=False, header_encoding='utf-8')
+            h2_connection = h2.connection.H2Connection(config=config)
+            h2_connection.initiate_connection()
+            if self._initial_window_size is not None:
+                h2_connection.update_settings(
+                    {h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: self._initial_window_size})
+            conn.sendall(h2_connection.data_to_send())
+            streams = {}
+            answered = 0
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                for event in h2_connection.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        streams[event.stream_id] = (dict(event.headers), [])
+                    elif isinstance(event, h2.events.DataReceived):
+                        streams[event.stream_id][1].append(event.data)
+                        h2_connection.acknowledge_received_data(
+                            event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        if self._goaway_after is not None and answered >= self._goaway_after:
+                            continue
+                        headers, body = streams.pop(event.stream_id)
+                        body = b''.join(body)
+                        self.requests.append((headers, body))
+                        self._respond(h2_connection, event.stream_id, headers, body)
+                        answered += 1
+                        if answered == self._goaway_after:
+                            h2_connection.close_connection(
+                                last_stream_id=event.stream_id,
+                                additional_data=b'{"reason":"Shutdown"}')
+                conn.sendall(h2_connection.data_to_send())
+                if self._goaway_after is not None and answered >= self._goaway_after:
+                    break
+        except (socket.error, ssl.SSLError):
+            pass
+        finally:
+            sock.close()
+
+    def _respond(self, h2_connection, stream_id, headers, body):
+        status, reason = self._responder(headers, body)
+        response_headers = [(':status', str(status)),
+                            ('apns-id', headers.get('apns-id', '%08d' % stream_id))]
+        if reason is None:
+            h2_connection.send_headers(stream_id, response_headers, end_stream=True)
+        else:
+            data = json.dumps({'reason': reason}).encode('utf-8')
+            h2_connection.send_headers(stream_id, response_headers)
+            h2_connection.send_data(stream_id, data, end_stream=True)
+
+    def close(self):
+        self._closed = True
+        self._listener.close()
+
+
+def _percentile(sorted_samples, fraction):
+    index = min(len(sorted_samples) - 1, int(round(fraction * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+def _summarize(count, elapsed, latencies):
+    latencies.sort()
+    return {
+        'notifications': count,
+        'seconds': elapsed,
+        'notifications_per_sec': count / elapsed if elapsed else None,
+        'latency_p50_us': _percentile(latencies, 0.5) * 1e6,
+        'latency_p99_us': _percentile(latencies, 0.99) * 1e6,
+    }
+
+
+def _gateway_connection(address, enhanced, **kwargs):
+    gateway = GatewayConnection(enhanced=enhanced, **kwargs)
+    gateway.server, gateway.port = address
+    return gateway
+
+
+def bench_send_notification(address, count, enhanced, **kwargs):
+    gateway = _gateway_connection(address, enhanced, **kwargs)
+    payload = Payload(alert="Hello World!", sound="default", badge=1)
+    # connect, and start the error-response worker, before timing
+    gateway.send_notification(TOKEN_HEX, payload, 0)
+    latencies = []
+    clock = time.time
+    start = clock()
+    for identifier in range(1, count + 1):
+        before = clock()
+        gateway.send_notification(TOKEN_HEX, payload, identifier)
+        latencies.append(clock() - before)
+    gateway.flush()
+    elapsed = clock() - start
+    if enhanced:
+        gateway.force_close()
+    else:
+        gateway._disconnect()
+    return _summarize(count, elapsed, latencies)
+
+
+def bench_frame(address, count):
+    gateway = _gateway_connection(address, True)
+    payload = Payload(alert="Hello World!", sound="default", badge=1)
+    gateway.send_notification(TOKEN_HEX, payload, 0)
+    latencies = []
+    clock = time.time
+    start = clock()
+    for first in range(1, count + 1, FRAME_SIZE):
+        before = clock()
+        frame = Frame()
+        for identifier in range(first, min(first + FRAME_SIZE, count + 1)):
+            frame.add_item(TOKEN_HEX, payload, identifier, 0, 10)
+        gateway.send_notification_multiple(frame)
+        latencies.append(clock() - before)
+    elapsed = clock() - start
+    gateway.force_close()
+    results = _summarize(count, elapsed, latencies)
+    results['frame_size'] = FRAME_SIZE
+    return results
+
+
+def bench_http2(address, count, concurrency=1000):
+    gateway = HTTP2GatewayConnection(topic='com.example.app')
+    gateway.server, gateway.port = address
+    payload = Payload(alert="Hello World!", sound="default", badge=1)
+    gateway.send_notification(TOKEN_HEX, payload, 0)
+    latencies = []
+    clock = time.time
+    start = clock()
+    for first in range(1, count + 1, concurrency):
+        before = clock()
+        responses = [gateway.submit(TOKEN_HEX, payload, identifier)
+                     for identifier in range(first, min(first + concurrency, count + 1))]
+        for response in responses:
+            response.wait()
+        latencies.append(clock() - before)
+    elapsed = clock() - start
+    gateway.close()
+    results = _summarize(count, elapsed, latencies)
+    results['concurrency'] = concurrency
+    return results
+
+
+def run(count=20000):
+    """
+    Runs the plain, enhanced, coalesced and frame benchmarks for count notifications
+    each, and the HTTP/2 benchmark if h2 is installed. Latencies are per
+    send_notification call, per frame in frame mode, or per batch of
+    concurrent streams over HTTP/2.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        server = LoopbackGateway(*make_self_signed_cert(directory))
+        try:
+            results = {
+                'plain': bench_send_notification(server.address, count, False),
+                'enhanced': bench_send_notification(server.address, count, True),
+                'coalesced': bench_send_notification(server.address, count, True,
+                                                     coalesce=True),
+                'frame': bench_frame(server.address, count),
+            }
+        finally:
+            server.close()
+        if h2 is not None:
+            server = LoopbackHTTP2Gateway(*make_self_signed_cert(directory))
+            try:
+                results['http2'] = bench_http2(server.address, count)
+            finally:
+                server.close()
+        return results
+    finally:
+        shutil.rmtree(directory)
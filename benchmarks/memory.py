@@ -0,0 +1,65 @@
+"""
+Memory held per 100k in-flight notifications, measured with tracemalloc.
+Needs Python 3.4+.
+"""
+
+import gc
+import tracemalloc
+
+from apns import Frame, GatewayConnection, Payload, PayloadAlert, SentNotificationBuffer
+
+TOKEN_HEX = 'b5bb9d8014a0f9b1d61e21e796d78dccdf1352f23cd32812f4850b878ae4944c'
+COUNT = 100000
+
+
+def _payload():
+    return Payload(alert="Hello World!", sound="default", badge=1)
+
+
+def _measure(build):
+    """Returns the MB still allocated by what build() returns"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        kept = build()
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del kept
+    return current / 1e6
+
+
+def build_payloads():
+    return [_payload() for _ in range(COUNT)]
+
+
+def build_alerts():
+    return [Payload(alert=PayloadAlert("Hello World!", title="Greetings"))
+            for _ in range(COUNT)]
+
+
+def build_frame():
+    payload = _payload()
+    frame = Frame()
+    for identifier in range(COUNT):
+        frame.add_item(TOKEN_HEX, payload, identifier, 0, 10)
+    return frame
+
+
+def build_resend_window():
+    message = GatewayConnection()._get_enhanced_notification(TOKEN_HEX, _payload(), 0, 0)
+    sent = SentNotificationBuffer()
+    for identifier in range(COUNT):
+        sent.append(identifier, message)
+    return sent
+
+
+def run():
+    """Returns the MB held by 100k of each kind of record"""
+    return {
+        'payloads': _measure(build_payloads),
+        'payloads_with_alert': _measure(build_alerts),
+        'frame_items': _measure(build_frame),
+        'resend_window': _measure(build_resend_window),
+    }
@@ -0,0 +1,96 @@
+"""Microbenchmarks of the encoding and parsing hot spots in apns"""
+
+import timeit
+from binascii import a2b_hex
+from struct import pack
+
+from apns import (Frame, FeedbackConnection, GatewayConnection, Payload,
+                  PayloadAlert, SentNotificationBuffer, Util)
+
+TOKEN_HEX = 'b5bb9d8014a0f9b1d61e21e796d78dccdf1352f23cd32812f4850b878ae4944c'
+
+
+def _payload():
+    return Payload(alert=PayloadAlert("Hello World!", title="Greetings"),
+                   sound="default", badge=4, custom={'id': 123456})
+
+
+def bench_payload_json(number):
+    payload = _payload()
+    def uncached():
+        payload.badge = 4
+        payload.json()
+    return {
+        'payload_json_cached': timeit.Timer(payload.json).timeit(number),
+        'payload_json_uncached': timeit.Timer(uncached).timeit(number),
+    }
+
+
+def bench_enhanced_notification(number):
+    gateway = GatewayConnection()
+    payload = _payload()
+    def encode():
+        gateway._get_enhanced_notification(TOKEN_HEX, payload, 1, 0)
+    return {'get_enhanced_notification': timeit.Timer(encode).timeit(number)}
+
+
+def bench_frame_add_item(number):
+    payload = _payload()
+    frame = Frame()
+    def add():
+        frame.add_item(TOKEN_HEX, payload, 1, 0, 10)
+    return {'frame_add_item': timeit.Timer(add).timeit(number)}
+
+
+def bench_feedback_items(number):
+    record = pack('>IH', 1500000000, 32) + a2b_hex(TOKEN_HEX)
+    data = record * number
+    def chunks():
+        for i in range(0, len(data), 4096):
+            yield data[i:i + 4096]
+        yield b''
+    feedback = FeedbackConnection()
+    feedback._chunks = chunks
+    def parse():
+        for _ in feedback.items():
+            pass
+    return {'feedback_items': timeit.Timer(parse).timeit(1)}
+
+
+def bench_sent_lookup(number):
+    size = 10000
+    the_list = [{'id': i, 'message': b''} for i in range(size)]
+    buff = SentNotificationBuffer()
+    for i in range(size):
+        buff.append(i, b'x' * 100)
+    def scan():
+        Util.getListIndexFromID(the_list, size - 1)
+    def lookup():
+        buff.get(size - 1)
+    # the linear scan is far slower, so time it fewer times
+    scan_number = max(1, number // 100)
+    return {
+        'get_list_index_from_id': timeit.Timer(scan).timeit(scan_number) * number / scan_number,
+        'sent_notification_buffer_get': timeit.Timer(lookup).timeit(number),
+    }
+
+
+BENCHMARKS = [
+    bench_payload_json,
+    bench_enhanced_notification,
+    bench_frame_add_item,
+    bench_feedback_items,
+    bench_sent_lookup,
+]
+
+
+def run(number=100000):
+    """
+    Runs every microbenchmark number times and returns a dict mapping each
+    name to the mean time per call in microseconds
+    """
+    results = {}
+    for bench in BENCHMARKS:
+        for name, seconds in bench(number).items():
+            results[name] = seconds / number * 1e6
+    return results
@@ -7,7 +7,7 @@ setup(
     download_url = 'https://github.com/djacobs/PyAPNs',
     license = 'unlicense.org',
     name = 'apns',
-    py_modules = ['apns'],
+    py_modules = ['apns', 'apns_async'],
     scripts = ['apns-send'],
     url = 'http://29.io/',
     version = '2.0.1',
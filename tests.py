@@ -1,11 +1,23 @@
 #!/usr/bin/env python
 # coding: utf-8
+import apns
 from apns import *
+from array import array
 from binascii import a2b_hex
+from datetime import datetime
+import socket
+from socket import socketpair
+from struct import pack
 from random import random
 
 import hashlib
+import json
 import os
+import shutil
+import ssl
+import sys
+import tempfile
+import threading
 import time
 import unittest
 
@@ -107,6 +119,80 @@ class TestAPNs(unittest.TestCase):
             i += 1
         self.assertEqual(i, NUM_MOCK_TOKENS)
 
+    def testFeedbackServerBatch(self):
+        feedback_server = FeedbackConnection(use_sandbox=True)
+        feedback_server._chunks = mock_chunks_generator
+
+        batches = list(feedback_server.items_batch(batch_size=4))
+        self.assertEqual([len(fail_times) for _, fail_times in batches], [4, 4, 2])
+        tokens = b''.join(bytes(t) for t, _ in batches)
+        self.assertEqual(tokens, b''.join(a2b_hex(t) for t in mock_tokens))
+
+    def testFeedbackHarvester(self):
+        def failing_chunks():
+            for chunk in mock_chunks_generator():
+                yield chunk
+                raise IOError('connection reset')
+
+        broken = set(['flaky'])
+        opened = []
+
+        class Harvester(FeedbackHarvester):
+            def _open_connection(self, app):
+                opened.append(app)
+                if app == 'unconfigured':
+                    raise IOError('no such cert_file')
+                connection = FeedbackConnection(use_sandbox=True)
+                connection._chunks = failing_chunks if app in broken else mock_chunks_generator
+                return connection
+
+        sink = SQLiteFeedbackSink(':memory:')
+        apps = dict((app, {}) for app in ('news', 'games', 'flaky'))
+        harvester = Harvester(apps, sink, threads=3, interval=3600, batch_size=4)
+        counts = harvester.run()
+        self.assertEqual(counts['news'], NUM_MOCK_TOKENS)
+        self.assertEqual(counts['games'], NUM_MOCK_TOKENS)
+        self.assertEqual(list(harvester.errors), ['flaky'])
+        self.assertEqual(sorted(t for t, _ in sink.items('news')), sorted(mock_tokens))
+        self.assertTrue(sink.get_checkpoint('news') is not None)
+        self.assertTrue(sink.get_checkpoint('flaky') is None)
+
+        # only the app that failed is polled again
+        broken.clear()
+        del opened[:]
+        counts = harvester.run()
+        self.assertEqual(opened, ['flaky'])
+        self.assertEqual(counts, {'flaky': NUM_MOCK_TOKENS})
+        self.assertEqual(harvester.errors, {})
+        self.assertEqual(len(list(sink.items('flaky'))), NUM_MOCK_TOKENS)
+
+        # failing to connect or to checkpoint fails only that app
+        class Sink(object):
+            def __init__(self):
+                self.added = []
+            def add(self, app, tokens, fail_times):
+                self.added.append(app)
+            def get_checkpoint(self, app):
+                return None
+            def set_checkpoint(self, app, harvested_at):
+                if app == 'news':
+                    raise IOError('disk full')
+        failing_sink = Sink()
+        apps = dict((app, {}) for app in ('news', 'games', 'unconfigured'))
+        harvester = Harvester(apps, failing_sink, threads=3, batch_size=4)
+        counts = harvester.run()
+        self.assertEqual(sorted(harvester.errors), ['news', 'unconfigured'])
+        self.assertEqual(counts, {'news': NUM_MOCK_TOKENS, 'games': NUM_MOCK_TOKENS,
+                                  'unconfigured': 0})
+        self.assertEqual(set(failing_sink.added), set(['news', 'games']))
+
+        # a token reported again keeps its latest fail time
+        token_bin = a2b_hex(mock_tokens[0])
+        sink.add('news', token_bin, array('I', [4102444800]))
+        sink.add('news', token_bin, array('I', [0]))
+        self.assertEqual(dict(sink.items('news'))[mock_tokens[0]], datetime(2100, 1, 1))
+        sink.close()
+
     def testPayloadAlert(self):
         pa = PayloadAlert('foo')
         d = pa.dict()
@@ -174,6 +260,21 @@ class TestAPNs(unittest.TestCase):
         d = p.dict()
         self.assertEqual(d, {'foo': 'bar', 'aps': {'alert': 'foobar'}})
 
+    def testPayloadJsonCache(self):
+        alert = PayloadAlert('foo')
+        p = Payload(alert=alert, badge=1)
+        encoded = p.json()
+        self.assertTrue(p.json() is encoded)
+
+        p.badge = 2
+        self.assertEqual(json.loads(p.json().decode('utf-8'))['aps']['badge'], 2)
+
+        alert.body = 'bar'
+        self.assertEqual(json.loads(p.json().decode('utf-8'))['aps']['alert']['body'], 'bar')
+
+        p.custom = {'foo': 'bar'}
+        self.assertEqual(json.loads(p.json().decode('utf-8'))['foo'], 'bar')
+
     def testFrame(self):
         identifier = 1
         expiry = 3600
@@ -192,6 +293,110 @@ class TestAPNs(unittest.TestCase):
         f2 = bytearray(b'\x02\x00\x00\x00t\x01\x00 \xb5\xbb\x9d\x80\x14\xa0\xf9\xb1\xd6\x1e!\xe7\x96\xd7\x8d\xcc\xdf\x13R\xf2<\xd3(\x12\xf4\x85\x0b\x87\x8a\xe4\x94L\x02\x00<{"aps":{"sound":"default","alert":"Hello World!","badge":4}}\x03\x00\x04\x00\x00\x00\x01\x04\x00\x04\x00\x00\x0e\x10\x05\x00\x01\n')
         self.assertTrue(f1 == frame.get_frame() or f2 == frame.get_frame())
 
+    def testFrameSplit(self):
+        token_hex = 'b5bb9d8014a0f9b1d61e21e796d78dccdf1352f23cd32812f4850b878ae4944c'
+        payload = Payload(alert="Hello World!")
+
+        frame = Frame()
+        frame.add_item(token_hex, payload, 1, 0, 10)
+        raw_frame = Frame()
+        raw_frame.add_item(a2b_hex(token_hex), payload, 1, 0, 10)
+        self.assertEqual(frame.get_frame(), raw_frame.get_frame())
+        item_size = len(frame.get_frame())
+
+        frame = Frame(max_size=item_size * 2)
+        for identifier in range(5):
+            frame.add_item(token_hex, payload, identifier, 0, 10)
+        frames = frame.get_frames()
+        self.assertEqual([len(f) for f in frames],
+                         [item_size * 2, item_size * 2, item_size])
+        self.assertEqual(b''.join(f.tobytes() for f in frames), bytes(frame.get_frame()))
+
+    def testFrameData(self):
+        payload = Payload(alert="Hello World!")
+        frame = Frame()
+        frame.add_item(mock_tokens[0], payload, 1, 0, 10)
+        # frame_data is still the frame's own bytearray
+        self.assertTrue(frame.get_frame() is frame.frame_data)
+        self.assertTrue(isinstance(frame.frame_data, bytearray))
+        size = len(frame.frame_data)
+        view = frame.get_frame_view()
+        self.assertEqual(view.tobytes(), bytes(frame.frame_data))
+        del view # releases the export, so frame_data can grow
+        frame.add_item(mock_tokens[1], payload, 2, 0, 10)
+        self.assertEqual(len(frame.frame_data), 2 * size)
+        frame.frame_data += b'\0' # callers may still append to it
+        self.assertEqual(len(frame.get_frame()), 2 * size + 1)
+
+        # a text token is always hex, even one of TOKEN_LENGTH characters
+        # (on Python 2 a str is bytes, so it is taken to be binary)
+        self.assertEqual(apns._get_token_bin(u'ab' * 16), a2b_hex('ab' * 16))
+        self.assertEqual(apns._get_token_bin(b'x' * 32), b'x' * 32)
+
+    def testFrameItemMessages(self):
+        frame = Frame()
+        payloads = [Payload(alert="Hello %d" % i) for i in range(3)]
+        for i, payload in enumerate(payloads):
+            frame.add_item(mock_tokens[i], payload, 10 + i, 0, 10)
+        messages = list(frame.get_item_messages())
+        self.assertEqual([i for i, _ in messages], [10, 11, 12])
+        self.assertEqual(b''.join(m.tobytes() for _, m in messages), bytes(frame.get_frame()))
+        for i, (_, message) in enumerate(messages):
+            single = Frame()
+            single.add_item(mock_tokens[i], payloads[i], 10 + i, 0, 10)
+            self.assertEqual(message.tobytes(), bytes(single.get_frame()))
+            self.assertEqual(apns._get_message_token(message), a2b_hex(mock_tokens[i]))
+
+        # the resend window takes the frame's bytes without encoding again
+        written = []
+        gateway = GatewayConnection()
+        gateway.write = written.append
+        gateway.send_notification_multiple(frame)
+        self.assertEqual([(i, m.tobytes()) for i, m in gateway._sent_notifications],
+                         [(i, m.tobytes()) for i, m in messages])
+        self.assertEqual(b''.join(data.tobytes() for data in written), bytes(frame.get_frame()))
+
+        enhanced = gateway._get_enhanced_notification(mock_tokens[0], payloads[0], 1, 0)
+        self.assertEqual(apns._get_message_token(enhanced), a2b_hex(mock_tokens[0]))
+
+    def testTokenStore(self):
+        store = TokenStore.from_hex(t.decode('ascii') + '\n' for t in mock_tokens)
+        self.assertEqual(len(store), NUM_MOCK_TOKENS)
+        self.assertEqual(store[-1].tobytes(), a2b_hex(mock_tokens[-1]))
+        self.assertEqual([len(c) for c in store.chunks(4)], [4, 4, 2])
+
+        # a token from the store is encoded as itself, not as its repr
+        payload = Payload(alert="Hello World!")
+        frame = Frame()
+        frame.add_item(store[0], payload, 1, 0, 10)
+        expected = Frame()
+        expected.add_item(mock_tokens[0], payload, 1, 0, 10)
+        self.assertEqual(frame.get_frame(), expected.get_frame())
+        gateway = GatewayConnection()
+        self.assertEqual(gateway._get_enhanced_notification(store[0], payload, 1, 0),
+                         gateway._get_enhanced_notification(mock_tokens[0], payload, 1, 0))
+        self.assertEqual(gateway._get_notification(store[0], payload),
+                         gateway._get_notification(mock_tokens[0], payload))
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            store.save(path)
+            mapped = TokenStore.open(path)
+            self.assertEqual([t.tobytes() for t in mapped], [a2b_hex(t) for t in mock_tokens])
+
+            frame = Frame()
+            frame.add_tokens(mapped, payload, 1, 0, 10)
+            expected = Frame()
+            for i, token_hex in enumerate(mock_tokens):
+                expected.add_item(token_hex, payload, 1 + i, 0, 10)
+            self.assertEqual(frame.get_frame(), expected.get_frame())
+            # the frame holds copies of the tokens, not views of the mmap
+            mapped.close()
+            self.assertEqual(frame.notification_data[-1].token, a2b_hex(mock_tokens[-1]))
+        finally:
+            os.remove(path)
+
     def testPayloadTooLargeError(self):
         # The maximum size of the JSON payload is MAX_PAYLOAD_LENGTH 
         # bytes. First determine how many bytes this allows us in the
@@ -209,5 +414,813 @@ class TestAPNs(unittest.TestCase):
         self.assertRaises(PayloadTooLargeError, Payload,
             u'\u0100' * (int(max_raw_payload_bytes / 2) + 1))
 
+    def testPayloadTruncated(self):
+        json_overhead_bytes = len(Payload('.').json()) - 1
+        max_raw_payload_bytes = MAX_PAYLOAD_LENGTH - json_overhead_bytes
+
+        # a body that fits is left alone
+        body = u'\u0100' * int(max_raw_payload_bytes / 2)
+        self.assertEqual(Payload.truncated(body).alert, body)
+
+        # 2-byte characters are cut to make room for the 3-byte ellipsis
+        payload = Payload.truncated(body + u'\u0100')
+        self.assertEqual(payload.alert, body[:-2] + u'\u2026')
+        self.assertTrue(len(payload.json()) <= MAX_PAYLOAD_LENGTH)
+
+        # escaped characters count as they are encoded, spaces before the
+        # ellipsis are dropped
+        alert = PayloadAlert(body=u'ab "cd" ef\n', title='Hi')
+        payload = Payload.truncated(alert, ellipsis=u'...', max_length=65, badge=1)
+        self.assertEqual(payload.alert.body, u'ab "cd"...')
+        self.assertEqual(payload.alert.title, 'Hi')
+        self.assertEqual(alert.body, u'ab "cd" ef\n')
+        self.assertEqual(len(payload.json()), 64)
+
+        self.assertRaises(PayloadTooLargeError, Payload.truncated, 'hello',
+                          max_length=10, custom={'key': 'value'})
+
+    def testSentNotificationBuffer(self):
+        buff = SentNotificationBuffer(maxlen=4)
+        for identifier in range(6):
+            buff.append(identifier, b'message %d' % identifier)
+        self.assertEqual(len(buff), 4)
+        self.assertEqual([i for i, _ in buff], [2, 3, 4, 5])
+        self.assertEqual(buff.get(1), None)
+        self.assertEqual(buff.get(3), b'message 3')
+
+        self.assertFalse(buff.drop_through(1))
+        self.assertTrue(buff.drop_through(3))
+        self.assertEqual([(i, m.tobytes()) for i, m in buff],
+                         [(4, b'message 4'), (5, b'message 5')])
+
+        # once max_bytes is reached the arena wraps around, dropping the
+        # oldest entries first
+        buff = SentNotificationBuffer(maxlen=100, max_bytes=25)
+        for identifier in range(5):
+            buff.append(identifier, b'%d' % identifier * 10)
+        self.assertEqual([(i, m.tobytes()) for i, m in buff],
+                         [(3, b'3' * 10), (4, b'4' * 10)])
+
+        # get() copies, so the message outlives the arena wrapping over it
+        message = buff.get(4)
+        buff.append(5, b'5' * 10)
+        buff.append(6, b'6' * 10)
+        self.assertEqual(message, b'4' * 10)
+
+        # a repeated identifier means its oldest copy, like getListIndexFromID
+        for maxlen in (100, 3):
+            buff = SentNotificationBuffer(maxlen=maxlen)
+            for identifier, message in ((7, b'a'), (0, b'b'), (0, b'c'), (1, b'd'), (0, b'e')):
+                buff.append(identifier, message)
+            oldest = b'b' if maxlen == 100 else b'c'
+            self.assertEqual(buff.get(0), oldest)
+            self.assertTrue(buff.drop_through(0))
+            self.assertEqual([m.tobytes() for _, m in buff],
+                             [b'c', b'd', b'e'] if maxlen == 100 else [b'd', b'e'])
+
+    def testCompactRecords(self):
+        payload = Payload(alert=PayloadAlert("Hello", title="Hi"), badge=1)
+        self.assertFalse(hasattr(payload, '__dict__'))
+        self.assertFalse(hasattr(payload.alert, '__dict__'))
+        self.assertRaises(AttributeError, setattr, payload, 'colour', 'red')
+
+        frame = Frame()
+        frame.add_item(mock_tokens[0], payload, 7, 0, 5)
+        item = frame.notification_data[0]
+        self.assertFalse(hasattr(item, '__dict__'))
+        self.assertEqual((item['identifier'], item['priority']), (7, 5))
+        self.assertEqual(item.token, a2b_hex(mock_tokens[0]))
+        self.assertRaises(KeyError, item.__getitem__, '__class__')
+
+        # increasing identifiers need no index; others build one
+        buff = SentNotificationBuffer(maxlen=4)
+        for identifier in (3, 5, 8, 9, 12):
+            buff.append(identifier, b'%d' % identifier)
+        self.assertTrue(buff._index is None)
+        self.assertEqual(buff.get(8), b'8')
+        self.assertEqual(buff.get(3), None)
+        self.assertEqual(buff.get(6), None)
+        buff.append(1, b'one')
+        self.assertEqual(buff.get(1), b'one')
+        self.assertEqual(buff.get(9), b'9')
+        self.assertEqual(buff.get(5), None)
+        self.assertTrue(buff.drop_through(9))
+        self.assertEqual([i for i, _ in buff], [12, 1])
+
+    def testCoalescedSend(self):
+        token_hex = 'b5bb9d8014a0f9b1d61e21e796d78dccdf1352f23cd32812f4850b878ae4944c'
+        payload = Payload(alert="Hello World!")
+        gateway = GatewayConnection(use_sandbox=True, enhanced=True, coalesce=True,
+                                    coalesce_count=3, coalesce_delay=0.05)
+        gateway._make_sure_error_response_handler_worker_alive = lambda: None
+        writes = []
+        gateway.write = lambda data: writes.append(apns._to_bytes(data)) or True
+        messages = [gateway._get_enhanced_notification(token_hex, payload, i, 0)
+                    for i in range(5)]
+
+        for identifier in range(5):
+            gateway.send_notification(token_hex, payload, identifier)
+        self.assertEqual(writes, [b''.join(messages[:3])])
+        self.assertEqual(len(gateway._sent_notifications), 5)
+
+        gateway.flush()
+        self.assertEqual(writes[1:], [b''.join(messages[3:])])
+
+        # the timer writes whatever is left after coalesce_delay
+        gateway.send_notification(token_hex, payload, 5)
+        time.sleep(0.2)
+        self.assertEqual(len(writes), 3)
+
+    def testWriteTimeout(self):
+        payload = Payload(alert="Hello World!")
+        metrics = MetricsRegistry()
+        gateway = GatewayConnection(use_sandbox=True, enhanced=True, coalesce=True,
+                                    metrics=metrics)
+        gateway._make_sure_error_response_handler_worker_alive = lambda: None
+        gateway.write = lambda data: False # never became writable
+        gateway.send_notification(mock_tokens[0], payload, 1)
+        gateway.send_notification(mock_tokens[1], payload, 2)
+        gateway.flush()
+        self.assertEqual(metrics.counter('notifications_dropped_total'), 2)
+
+        # a peer that stops reading makes _sendall give up and disconnect
+        class StalledSocket(object):
+            def __init__(self, sock):
+                self.sock = sock
+            def fileno(self):
+                return self.sock.fileno()
+            def send(self, data):
+                raise ssl.SSLError(ssl.SSL_ERROR_WANT_WRITE, 'write would block')
+            def close(self):
+                self.sock.close()
+
+        gateway = GatewayConnection(use_sandbox=True, enhanced=True)
+        sock, peer = socketpair()
+        gateway._ssl = StalledSocket(sock)
+        gateway._socket = None
+        gateway.connection_alive = True
+        timeout_sec = apns.WAIT_WRITE_TIMEOUT_SEC
+        apns.WAIT_WRITE_TIMEOUT_SEC = 0.1
+        try:
+            self.assertRaises(socket.timeout, gateway._sendall, b'notification')
+        finally:
+            apns.WAIT_WRITE_TIMEOUT_SEC = timeout_sec
+            peer.close()
+        self.assertFalse(gateway.connection_alive)
+
+    def testSendNotifications(self):
+        payload = Payload(alert="Hello World!")
+        gateway = GatewayConnection(use_sandbox=True, enhanced=True)
+        gateway._make_sure_error_response_handler_worker_alive = lambda: None
+        gateway.connection_alive = True
+        consumed = []
+        writes = []
+
+        def notifications():
+            for identifier in range(25):
+                consumed.append(identifier)
+                yield mock_tokens[identifier % NUM_MOCK_TOKENS], payload, identifier, 0, 10
+
+        def write(data):
+            writes.append((len(consumed), apns._to_bytes(data)))
+            if len(writes) == 2:
+                # APNs rejects the token of notification 12
+                gateway.read = lambda n: pack(ERROR_RESPONSE_FORMAT, 8, 8, 12)
+                gateway._read_error_response()
+            return True
+        gateway.write = write
+
+        summary = gateway.send_notifications(notifications(), chunk_size=10, linger=0)
+        # 12 is failed, not sent as well
+        self.assertEqual((summary.sent, summary.failed, summary.resent), (24, 1, 7))
+        self.assertEqual(summary.invalid_tokens, [mock_tokens[2]])
+        # each chunk was taken from the generator just before its write
+        self.assertEqual([n for n, _ in writes], [10, 20, 20, 20, 20, 20, 20, 20, 20, 25])
+        frame = Frame()
+        for identifier in range(10):
+            frame.add_item(mock_tokens[identifier % NUM_MOCK_TOKENS], payload, identifier, 0, 10)
+        self.assertEqual(writes[0][1], bytes(frame.get_frame()))
+        self.assertEqual(gateway._summaries, [])
+
+    def testInvalidTokenFilter(self):
+        payload = Payload(alert="Hello World!")
+        for capacity in (None, 1000):
+            invalid_tokens = InvalidTokenFilter(capacity=capacity)
+            invalid_tokens.add(mock_tokens[0])
+            invalid_tokens.add(a2b_hex(mock_tokens[1]))
+            self.assertTrue(mock_tokens[0] in invalid_tokens)
+            self.assertTrue(a2b_hex(mock_tokens[1]) in invalid_tokens)
+            self.assertFalse(mock_tokens[2] in invalid_tokens)
+
+            directory = tempfile.mkdtemp()
+            path = os.path.join(directory, 'invalid_tokens.bin')
+            try:
+                invalid_tokens.save(path)
+                loaded = InvalidTokenFilter.load(path)
+            finally:
+                shutil.rmtree(directory)
+            self.assertEqual(len(loaded), 2)
+            self.assertTrue(mock_tokens[1] in loaded)
+            self.assertFalse(mock_tokens[2] in loaded)
+
+        # fed by the feedback service
+        invalid_tokens = InvalidTokenFilter()
+        feedback_server = FeedbackConnection(use_sandbox=True, invalid_tokens=invalid_tokens)
+        feedback_server._chunks = mock_chunks_generator
+        items = feedback_server.items()
+        token_hex, _ = next(items)
+        # not until the caller asks for the next one, having stored it
+        self.assertFalse(token_hex in invalid_tokens)
+        next(items)
+        self.assertTrue(token_hex in invalid_tokens)
+        self.assertEqual(len(list(items)), NUM_MOCK_TOKENS - 2)
+        self.assertEqual(len(invalid_tokens), NUM_MOCK_TOKENS)
+
+        invalid_tokens = InvalidTokenFilter()
+        feedback_server = FeedbackConnection(use_sandbox=True, invalid_tokens=invalid_tokens)
+        feedback_server._chunks = mock_chunks_generator
+        batches = feedback_server.items_batch(4)
+        next(batches)
+        self.assertEqual(len(invalid_tokens), 0)
+        next(batches)
+        self.assertEqual(len(invalid_tokens), 4)
+        for _ in batches:
+            pass
+        self.assertEqual(len(invalid_tokens), NUM_MOCK_TOKENS)
+
+        # the Bloom filter's probes never collapse onto one position
+        invalid_tokens = InvalidTokenFilter(capacity=100)
+        for i in range(1000):
+            positions = list(invalid_tokens._positions(hashlib.sha256(str(i).encode()).digest()))
+            self.assertTrue(all(a != b for a, b in zip(positions, positions[1:])))
+
+        # fed by error-responses, and checked before sending
+        invalid_tokens = InvalidTokenFilter()
+        gateway = GatewayConnection(use_sandbox=True, enhanced=True,
+                                    invalid_tokens=invalid_tokens)
+        gateway._make_sure_error_response_handler_worker_alive = lambda: None
+        gateway.connection_alive = True
+        writes = []
+        gateway.write = lambda data: writes.append(apns._to_bytes(data)) or True
+        for identifier in range(3):
+            gateway.send_notification(mock_tokens[identifier], payload, identifier)
+        gateway.read = lambda n: pack(ERROR_RESPONSE_FORMAT, 8, 8, 1)
+        gateway._read_error_response()
+        self.assertTrue(mock_tokens[1] in invalid_tokens)
+
+        del writes[:]
+        self.assertTrue(gateway.send_notification(mock_tokens[1], payload, 3) is False)
+        self.assertEqual(writes, [])
+        notifications = [(mock_tokens[i], payload, 4 + i, 0, 10) for i in range(3)]
+        summary = gateway.send_notifications(notifications, linger=0)
+        self.assertEqual((summary.sent, summary.suppressed), (2, 1))
+        self.assertEqual(len(gateway._sent_notifications), 3) # 2, then the frame
+
+    def testGatewayConnectionManager(self):
+        manager = GatewayConnectionManager(max_connections=2)
+        responses = []
+        manager.register_response_listener(lambda key, response: responses.append(key))
+        news = manager.get('news.pem')
+        games = manager.get('games.pem', use_sandbox=True)
+        self.assertTrue(manager.get('news.pem') is news)
+        self.assertEqual((news.cert_file, news.server), ('news.pem', 'gateway.push.apple.com'))
+        self.assertTrue(games.enhanced)
+        # without selectors, Python 2, each reads on a thread instead
+        self.assertEqual(bool(games._reactor), apns.selectors is not None)
+
+        # games is the least recently used, so it makes way for weather
+        games._tls_session, games._tls_session_context = 'session', 'context'
+        weather = manager.get('weather.pem')
+        self.assertEqual(len(manager), 2)
+        self.assertTrue(manager.get('news.pem') is news)
+        games_again = manager.get('games.pem', use_sandbox=True)
+        self.assertFalse(games_again is games)
+        self.assertEqual(games_again._tls_session, 'session') # resumed, not a full handshake
+        self.assertEqual(list(manager._connections),
+                         [('news.pem', None, False), ('games.pem', None, True)])
+
+        games_again._response_listener({'status': 8, 'identifier': 1})
+        self.assertEqual(responses, [('games.pem', None, True)])
+
+        # connections not used for idle_timeout secs are closed
+        key = ('news.pem', None, False)
+        manager._connections[key] = (news, time.time() - manager.idle_timeout)
+        manager.close_idle()
+        self.assertEqual(list(manager._connections), [('games.pem', None, True)])
+        manager.force_close()
+        self.assertEqual(len(manager), 0)
+
+    @unittest.skipIf(selectors is None, "needs the selectors module")
+    def testErrorResponseReactor(self):
+        reactor = ErrorResponseReactor()
+        reactor.start()
+        responses = []
+        resent = []
+        connections = []
+        try:
+            for i in range(2):
+                gateway = GatewayConnection(use_sandbox=True, enhanced=True, reactor=reactor)
+                gateway._ssl, apns_end = socketpair()
+                gateway._socket = None
+                gateway.connection_alive = True
+                gateway.read = gateway._ssl.recv
+                gateway.write = lambda data, i=i: resent.append(
+                    (i, apns._to_bytes(data), threading.current_thread()))
+                gateway.register_response_listener(responses.append)
+                for identifier in range(3):
+                    gateway._sent_notifications.append(identifier, b'message %d' % identifier)
+                reactor.register(gateway)
+                connections.append((gateway, apns_end))
+
+            connections[1][1].sendall(pack(ERROR_RESPONSE_FORMAT, 8, 8, 0))
+            for _ in range(100):
+                if len(resent) == 2:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(responses, [{'status': 8, 'identifier': 0}])
+            self.assertEqual([(i, data) for i, data, _ in resent],
+                             [(1, b'message 1'), (1, b'message 2')])
+            # resent off the reactor thread, which only reads
+            self.assertFalse(resent[0][2] is reactor)
+            self.assertFalse(connections[1][0].connection_alive)
+            self.assertTrue(connections[0][0].connection_alive)
+
+            # force_close disconnects right away
+            connections[0][0].force_close()
+            self.assertFalse(connections[0][0].connection_alive)
+        finally:
+            reactor.close()
+            reactor.join(1)
+            for _, apns_end in connections:
+                apns_end.close()
+        self.assertFalse(reactor.is_alive())
+
+    def testSendQueue(self):
+        token_hex = 'b5bb9d8014a0f9b1d61e21e796d78dccdf1352f23cd32812f4850b878ae4944c'
+        payload = Payload(alert="Hello World!")
+        gateway = GatewayConnection(use_sandbox=True, enhanced=True,
+                                    send_queue_size=4, send_queue_low_water=1)
+        gateway._make_sure_error_response_handler_worker_alive = lambda: None
+        writes = []
+        writable = threading.Event()
+        def write(data):
+            writable.wait()
+            writes.append(apns._to_bytes(data))
+            return True
+        gateway.write = write
+
+        # the writer takes the first notification and blocks on the socket,
+        # then the queue fills up to its high water mark
+        gateway.enqueue_notification(token_hex, payload, 0)
+        time.sleep(0.1)
+        for identifier in range(1, 5):
+            gateway.enqueue_notification(token_hex, payload, identifier)
+        self.assertRaises(SendQueueFull, gateway.enqueue_notification,
+                          token_hex, payload, 5, block=False)
+        self.assertRaises(SendQueueFull, gateway.enqueue_notification,
+                          token_hex, payload, 5, timeout=0.05)
+
+        writable.set()
+        gateway.enqueue_notification(token_hex, payload, 5, timeout=1)
+        self.assertTrue(gateway.flush(timeout=1))
+        expected = b''.join(gateway._get_enhanced_notification(token_hex, payload, i, 0)
+                            for i in range(6))
+        self.assertEqual(b''.join(writes), expected)
+        self.assertEqual([i for i, _ in gateway._sent_notifications], list(range(6)))
+        gateway._send_queue.close()
+        self.assertRaises(SendQueueClosed, gateway.enqueue_notification, token_hex, payload, 6)
+
+        # a socket that never becomes writable is retried WRITE_RETRY times
+        attempts = []
+        gateway = GatewayConnection(use_sandbox=True, enhanced=True, send_queue_size=4)
+        gateway._make_sure_error_response_handler_worker_alive = lambda: None
+        gateway.write = lambda data: attempts.append(data) and False
+        self.assertFalse(gateway._write_queued([(0, b'message')]))
+        self.assertEqual(len(attempts), WRITE_RETRY)
+
+    def testSingleWriter(self):
+        self.assertRaises(ValueError, GatewayConnection, enhanced=True,
+                          single_writer=True, coalesce=True)
+        gateway = GatewayConnection(use_sandbox=True, enhanced=True, single_writer=True)
+        peers = []
+
+        def connect():
+            gateway._ssl, apns_end = socketpair()
+            gateway.connection_alive = True
+            peers.append(apns_end)
+        gateway._connect = connect
+        gateway.read = lambda n: gateway._ssl.recv(n)
+
+        def received(peer, size):
+            data = b''
+            peer.settimeout(5)
+            while len(data) < size:
+                data += peer.recv(size - len(data))
+            return data
+
+        payload = Payload(alert="Hello World!")
+        def produce(thread):
+            for i in range(50):
+                gateway.send_notification(mock_tokens[thread], payload, thread * 1000 + i)
+        producers = [threading.Thread(target=produce, args=(t,)) for t in range(8)]
+        for producer in producers:
+            producer.start()
+        for producer in producers:
+            producer.join()
+        self.assertTrue(gateway.flush(5))
+
+        window = [(i, m.tobytes()) for i, m in gateway._sent_notifications]
+        self.assertEqual(sorted(i for i, _ in window),
+                         sorted(t * 1000 + i for t in range(8) for i in range(50)))
+        expected = b''.join(m for _, m in window)
+        self.assertEqual(received(peers[0], len(expected)), expected)
+
+        # the writer reads the error-response and resends the rest
+        failed = window[100][0]
+        peers[0].sendall(pack(ERROR_RESPONSE_FORMAT, 8, 8, failed))
+        expected = b''.join(m for _, m in window[101:])
+        for _ in range(500):
+            if len(peers) > 1:
+                break
+            time.sleep(0.01)
+        self.assertEqual(received(peers[1], len(expected)), expected)
+
+        # a write that found the socket unwritable is retried on a new connection
+        write = gateway.write
+        results = [False]
+        gateway.write = lambda data: results.pop() if results else write(data)
+        gateway.send_notification(mock_tokens[0], payload, 9000)
+        self.assertTrue(gateway.flush(5))
+        self.assertEqual(len(peers), 3)
+        message = gateway._sent_notifications.get(9000)
+        self.assertEqual(received(peers[2], len(message)), message)
+
+        gateway.force_close()
+        for _ in range(500):
+            if gateway._writer_thread is None:
+                break
+            time.sleep(0.01)
+        self.assertTrue(gateway._writer_thread is None)
+        self.assertFalse(gateway.connection_alive)
+        for peer in peers:
+            peer.close()
+
+    def testMetrics(self):
+        token_hex = 'b5bb9d8014a0f9b1d61e21e796d78dccdf1352f23cd32812f4850b878ae4944c'
+        payload = Payload(alert="Hello World!")
+        metrics = MetricsRegistry()
+        gateway = GatewayConnection(use_sandbox=True, enhanced=True, metrics=metrics)
+        gateway._make_sure_error_response_handler_worker_alive = lambda: None
+        gateway._ssl, apns_end = socketpair()
+        gateway.connection_alive = True
+        gateway.read = gateway._ssl.recv
+        gateway.write = lambda data: True
+        try:
+            for identifier in range(3):
+                gateway.send_notification(token_hex, payload, identifier)
+            apns_end.sendall(pack(ERROR_RESPONSE_FORMAT, 8, 8, 0))
+            gateway._read_error_response()
+        finally:
+            apns_end.close()
+
+        self.assertEqual(metrics.counter('notifications_sent_total'), 3)
+        self.assertEqual(metrics.counter('notifications_resent_total'), 2)
+        self.assertEqual(metrics.counter('error_responses_total', {'status': 8}), 1)
+        self.assertEqual(metrics.histogram('resend_batch_size'), (2, 1))
+        self.assertEqual(metrics.histogram('error_response_turnaround_seconds')[1], 1)
+
+        text = metrics.prometheus_text()
+        self.assertTrue('# TYPE apns_notifications_sent_total counter\n'
+                        'apns_notifications_sent_total 3\n' in text)
+        self.assertTrue('apns_error_responses_total{status="8"} 1\n' in text)
+        self.assertTrue('apns_resend_batch_size_bucket{le="10.0"} 1\n' in text)
+        self.assertTrue('apns_resend_batch_size_bucket{le="+Inf"} 1\n' in text)
+
+        # writes that never happened are not counted as sent
+        metrics = MetricsRegistry()
+        gateway = GatewayConnection(use_sandbox=True, enhanced=True, metrics=metrics)
+        gateway._make_sure_error_response_handler_worker_alive = lambda: None
+        writes = []
+        def write(data):
+            writes.append(data)
+            return len(writes) == 1 # then the socket stops being writable
+        gateway.write = write
+        frame = Frame(max_size=200) # two chunks of two notifications
+        for identifier in range(4):
+            frame.add_item(token_hex, payload, identifier, 0, 10)
+        self.assertFalse(gateway.send_notification_multiple(frame))
+        self.assertEqual(len(writes), 2) # the second chunk was not written
+        self.assertEqual(metrics.counter('notifications_sent_total'), 2)
+
+    def _self_signed_cert(self):
+        try:
+            from benchmarks.gateway import make_self_signed_cert
+            return make_self_signed_cert(tempfile.mkdtemp())
+        except (ImportError, OSError):
+            self.skipTest("needs the openssl command line tool")
+
+    def testSslContextSessionReuse(self):
+        from benchmarks.gateway import LoopbackGateway
+        cert_file, key_file = self._self_signed_cert()
+
+        context = apns._get_ssl_context(cert_file, key_file)
+        self.assertTrue(context is apns._get_ssl_context(cert_file, key_file))
+        os.utime(cert_file, (0, 0))
+        self.assertFalse(context is apns._get_ssl_context(cert_file, key_file))
+
+        server = LoopbackGateway(cert_file, key_file)
+        metrics = MetricsRegistry()
+        gateway = GatewayConnection(cert_file=cert_file, key_file=key_file,
+                                    enhanced=False, metrics=metrics)
+        gateway.server, gateway.port = server.address
+        for i in range(3):
+            gateway.send_notification(mock_tokens[0], Payload(alert="hi"), i)
+            time.sleep(0.05)
+            gateway._disconnect()
+        server.close()
+        self.assertEqual(metrics.counter('reconnects_total'), 2)
+        if hasattr(ssl, 'SSLSession'): # Python 3.6+
+            self.assertEqual(metrics.counter('tls_sessions_reused_total'), 2)
+
+        # the gateway's name is sent as SNI, but, as before, neither the
+        # name nor the certificate chain is verified
+        context = apns._get_ssl_context(cert_file, key_file)
+        self.assertFalse(context.check_hostname)
+        self.assertEqual(context.verify_mode, ssl.CERT_NONE)
+        gateway = GatewayConnection(use_sandbox=True, cert_file=cert_file, key_file=key_file)
+        ssl_sock = gateway._wrap_socket(socket.socket(), context, do_handshake_on_connect=False)
+        self.assertEqual(ssl_sock.server_hostname, 'gateway.sandbox.push.apple.com')
+        ssl_sock.close()
+
+        # disconnecting an enhanced connection leaves unread bytes alone,
+        # as they may be an error-response
+        class PendingSocket(object):
+            session = type('Session', (), {'has_ticket': False})()
+            def version(self):
+                return 'TLSv1.3'
+            def recv(self, n):
+                raise AssertionError("read at disconnect")
+            def close(self):
+                pass
+        gateway = GatewayConnection(use_sandbox=True, enhanced=True)
+        gateway._ssl, gateway._socket = PendingSocket(), None
+        gateway.connection_alive = True
+        gateway._disconnect()
+        self.assertFalse(gateway.connection_alive)
+
+    def testWarmConnection(self):
+        from benchmarks.gateway import LoopbackGateway
+        cert_file, key_file = self._self_signed_cert()
+        server = LoopbackGateway(cert_file, key_file)
+        metrics = MetricsRegistry()
+        gateway = GatewayConnection(cert_file=cert_file, key_file=key_file,
+                                    enhanced=True, warm=True, metrics=metrics)
+        gateway.server, gateway.port = server.address
+
+        def wait_for_standby():
+            for _ in range(200):
+                if gateway.connection_alive and gateway._standby is not None:
+                    return True
+                time.sleep(0.01)
+            return False
+
+        try:
+            self.assertTrue(gateway.keepalive)
+            gateway.warm_up()
+            self.assertTrue(wait_for_standby())
+            self.assertFalse(gateway._is_idle_timeout())
+            # closing reconnects in the background, using the standby
+            with gateway._send_lock:
+                gateway._disconnect()
+            self.assertTrue(wait_for_standby())
+            self.assertEqual(metrics.counter('standby_connections_used_total'), 1)
+            gateway.send_notification(mock_tokens[0], Payload(alert="hi"), 1)
+        finally:
+            gateway.force_close()
+            server.close()
+        self.assertTrue(gateway._standby is None)
+
+    @unittest.skipIf(apns.h2 is None, "needs the h2 package")
+    def testHTTP2GatewayConnection(self):
+        from benchmarks.gateway import LoopbackHTTP2Gateway
+        cert_file, key_file = self._self_signed_cert()
+        bad_token = '00' * TOKEN_LENGTH
+
+        def responder(headers, body):
+            if headers[':path'] == '/3/device/' + bad_token:
+                return 400, 'BadDeviceToken'
+            return 200, None
+
+        server = LoopbackHTTP2Gateway(cert_file, key_file, responder, goaway_after=30)
+        gateway = HTTP2GatewayConnection(topic='com.example.app', timeout=5)
+        gateway.server, gateway.port = server.address
+        payload = Payload(alert="hi")
+        try:
+            responses = [gateway.submit(bad_token if i % 10 == 0 else mock_tokens[0], payload, i)
+                         for i in range(100)]
+            for response in responses:
+                self.assertTrue(response.wait(5))
+            response = gateway.send_notification(a2b_hex(mock_tokens[0]), Payload(content_available=True),
+                                                 100, priority=5, collapse_id='news')
+        finally:
+            gateway.close(5)
+            server.close()
+
+        # streams cut off by each GOAWAY were sent again on a new connection
+        self.assertEqual(server.connections, 4)
+        self.assertEqual(len(server.requests), 101)
+        self.assertEqual([r.identifier for r in responses if not r.ok], list(range(0, 100, 10)))
+        self.assertEqual(set((r.status, r.reason) for r in responses if not r.ok),
+                         set([(400, 'BadDeviceToken')]))
+        self.assertTrue(response.ok)
+        headers, body = server.requests[-1]
+        self.assertEqual(headers[':path'], '/3/device/' + mock_tokens[0].decode('ascii'))
+        self.assertEqual(headers['apns-push-type'], 'background')
+        self.assertEqual(headers['apns-priority'], '5')
+        self.assertEqual(headers['apns-topic'], 'com.example.app')
+        self.assertEqual(headers['apns-collapse-id'], 'news')
+        self.assertEqual(json.loads(body.decode('utf-8')), {'aps': {'content-available': 1}})
+        self.assertRaises(ValueError, gateway.submit, mock_tokens[0], payload)
+
+        # bodies larger than a stream's window are sent as APNs opens it
+        server = LoopbackHTTP2Gateway(cert_file, key_file, initial_window_size=16)
+        gateway = HTTP2GatewayConnection(topic='com.example.app', timeout=5)
+        gateway.server, gateway.port = server.address
+        payload = Payload(alert="a longer alert than the window")
+        try:
+            responses = [gateway.submit(mock_tokens[0], payload, i) for i in range(3)]
+            for response in responses:
+                self.assertTrue(response.wait(5))
+                self.assertTrue(response.ok)
+        finally:
+            gateway.close(5)
+            server.close()
+        self.assertEqual([body for _, body in server.requests], [payload.json()] * 3)
+
+    @unittest.skipIf(apns.h2 is None, "needs the h2 package")
+    def testHTTP2UnknownStream(self):
+        import h2.events
+        gateway = HTTP2GatewayConnection(topic='com.example.app')
+        events = []
+        for cls in (h2.events.ResponseReceived, h2.events.DataReceived,
+                    h2.events.StreamEnded, h2.events.StreamReset):
+            event = cls.__new__(cls) # the constructors vary across h2 versions
+            event.stream_id = 7
+            event.headers = [(':status', '200')]
+            event.data = b'{}'
+            event.flow_controlled_length = 2
+            events.append(event)
+        acknowledged = []
+
+        class Connection(object):
+            def receive_data(self, data):
+                return events
+            def acknowledge_received_data(self, length, stream_id):
+                acknowledged.append((length, stream_id))
+
+        gateway._ssl = type('Socket', (), {'recv': lambda self, n: b'frames'})()
+        gateway._h2 = Connection()
+        # e.g. a stream completed as lost; nothing raises
+        gateway._receive()
+        self.assertEqual(acknowledged, [(2, 7)])
+        self.assertEqual(gateway._streams, {})
+
+    def testGatewayConnectionPool(self):
+        token_hex = 'b5bb9d8014a0f9b1d61e21e796d78dccdf1352f23cd32812f4850b878ae4944c'
+        payload = Payload(alert="Hello World!")
+        pool = GatewayConnectionPool(size=3, use_sandbox=True)
+        written = []
+        for connection in pool.connections:
+            connection.write = lambda data, c=connection: written.append(c)
+
+        for _ in range(6):
+            pool.send_notification(token_hex, payload)
+        self.assertEqual(written, pool.connections * 2)
+
+        # a connection that is busy sending is skipped
+        pool._loads[0] = 1
+        pool._next = 0
+        pool.send_notification(token_hex, payload)
+        self.assertEqual(written[-1], pool.connections[1])
+
+        # threads sharing a simple format connection take turns writing
+        pool = GatewayConnectionPool(size=1, use_sandbox=True)
+        writing = []
+        overlapped = []
+        def write(data):
+            overlapped.append(bool(writing))
+            writing.append(data)
+            time.sleep(0.01)
+            writing.pop()
+        pool.connections[0].write = write
+        threads = [threading.Thread(target=pool.send_notification, args=(token_hex, payload))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(overlapped, [False] * 4)
+
+    def testPriorityScheduler(self):
+        sent = []
+        release = threading.Event()
+
+        class Gateway(object):
+            def send_notification_multiple(self, frame):
+                release.wait(5)
+                sent.append([(item['identifier'], item['priority']) for item in frame.notification_data])
+
+        scheduler = PriorityScheduler(Gateway(), app_weights={'news': 3}, batch_size=4)
+        payload = Payload(alert="hi")
+        scheduler.submit(mock_tokens[0], payload, 0)
+        time.sleep(0.05) # the dispatcher is now sending notification 0
+        for identifier in range(1, 5):
+            scheduler.submit(mock_tokens[0], payload, identifier, priority=5)
+        for identifier in range(5, 9):
+            scheduler.submit(mock_tokens[0], payload, identifier, app='news')
+        for identifier in range(9, 11):
+            scheduler.submit(mock_tokens[0], payload, identifier, app='chat')
+        release.set()
+        self.assertTrue(scheduler.close(5))
+        self.assertEqual(sent[0], [(0, 10)])
+        # the high lane goes first, 3 news to 1 chat
+        self.assertEqual(sent[1], [(5, 10), (6, 10), (9, 10), (7, 10)])
+        self.assertEqual(sent[2], [(8, 10), (10, 10)])
+        self.assertEqual(sent[3], [(i, 5) for i in range(1, 5)])
+        self.assertRaises(ValueError, scheduler.submit, mock_tokens[0], payload)
+
+        # a rate capped lane lets lower lanes through
+        sent[:] = []
+        scheduler = PriorityScheduler(Gateway(), lane_rates={10: 1}, batch_size=10)
+        for identifier in range(3):
+            scheduler.submit(mock_tokens[0], payload, identifier)
+        scheduler.submit(mock_tokens[0], payload, 3, priority=5)
+        self.assertFalse(scheduler.flush(0.5))
+        self.assertEqual(sent[:2], [[(0, 10)], [(3, 5)]])
+
+        # a malformed token costs its batch, not the dispatcher
+        sent[:] = []
+        scheduler = PriorityScheduler(Gateway(), batch_size=2)
+        scheduler.submit('not a token', payload, 0)
+        scheduler.submit(mock_tokens[0], payload, 1)
+        scheduler.submit(mock_tokens[0], payload, 2)
+        self.assertTrue(scheduler.close(5))
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(sent, [[(2, 10)]])
+        self.assertEqual(scheduler.dropped, 2)
+
+        # as is a batch the gateway could not write
+        class UnwritableGateway(object):
+            def send_notification_multiple(self, frame):
+                return False
+        scheduler = PriorityScheduler(UnwritableGateway(), batch_size=2)
+        for identifier in range(3):
+            scheduler.submit(mock_tokens[0], payload, identifier)
+        self.assertTrue(scheduler.close(5))
+        self.assertEqual(scheduler.dropped, 3)
+
+    def testBroadcastChunk(self):
+        import apns
+        tokens = [t.decode('ascii') + '\n' for t in mock_tokens] + ['\n']
+        chunks = list(apns._iter_broadcast_chunks(tokens, 4))
+        self.assertEqual([start for start, _ in chunks], [0, 4, 8])
+        self.assertEqual(sum(len(c) for _, c in chunks), NUM_MOCK_TOKENS)
+
+        payload = Payload(alert="Hello World!")
+        gateway = GatewayConnection(use_sandbox=True, enhanced=True)
+        sent = []
+        def send_notification(token_hex, payload, identifier, expiry):
+            message = gateway._get_enhanced_notification(token_hex, payload, identifier, expiry)
+            gateway._sent_notifications.append(identifier, message)
+            sent.append(identifier)
+            if identifier == 5:
+                gateway._response_listener({'status': 8, 'identifier': 5})
+                gateway._resent_count += 2
+            return identifier != 7 # the socket never became writable
+        gateway.send_notification = send_notification
+        apns._set_broadcast_gateway(gateway, payload, 0, 0)
+
+        summary = SendSummary()
+        for chunk in chunks:
+            summary.merge(apns._broadcast_chunk(chunk))
+        self.assertEqual(sent, list(range(NUM_MOCK_TOKENS)))
+        # 5 was reported, 7 never written
+        self.assertEqual(summary.sent, NUM_MOCK_TOKENS - 2)
+        self.assertEqual(summary.failed, 2)
+        # the token as it was given
+        self.assertEqual(summary.invalid_tokens, [mock_tokens[5].decode('ascii')])
+        self.assertEqual(summary.resent, 2)
+
+        # an error-response arriving after the last chunk is still counted
+        # once the worker closes its connection
+        gateway._response_listener({'status': 8, 'identifier': 9})
+        summary = apns._finish_broadcast_worker(0)
+        self.assertEqual((summary.sent, summary.failed), (-1, 1)) # 9 was sent earlier
+        self.assertEqual(summary.invalid_tokens, [mock_tokens[9].decode('ascii')])
+        self.assertFalse(gateway.connection_alive)
+
 if __name__ == '__main__':
+    if sys.version_info >= (3, 7):
+        # async def does not parse on Python 2
+        from tests_async import TestAsyncAPNs
     unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding: utf-8
+# The asyncio tests, apart from tests.py as they need Python 3.7 or later
+import asyncio
+import unittest
+from struct import pack, unpack
+
+from apns import ERROR_RESPONSE_FORMAT, Frame, GatewayConnection, Payload
+from apns_async import AsyncGatewayConnection
+
+mock_tokens = [b'b5bb9d8014a0f9b1d61e21e796d78dccdf1352f23cd32812f4850b878ae4944c',
+               b'7d865e959b2466918c9863afca942d0fb89d7c9ac0c99bafc3749504ded97730']
+
+class TestAsyncAPNs(unittest.TestCase):
+    def testAsyncGatewayResend(self):
+        token_hex = 'b5bb9d8014a0f9b1d61e21e796d78dccdf1352f23cd32812f4850b878ae4944c'
+        payload = Payload(alert="Hello World!")
+        received = []
+        responses = []
+
+        async def handle(reader, writer):
+            data = await reader.read(4096)
+            while data:
+                received.append(data)
+                if len(received) == 1:
+                    # reject the first notification as an invalid token
+                    writer.write(pack(ERROR_RESPONSE_FORMAT, 8, 8, 1))
+                    await writer.drain()
+                    break
+                data = await reader.read(4096)
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            gateway = AsyncGatewayConnection(use_sandbox=True)
+            gateway.server, gateway.port = server.sockets[0].getsockname()[:2]
+            gateway._get_ssl_context = lambda: None
+            gateway.register_response_listener(responses.append)
+
+            for identifier in (1, 2, 3):
+                await gateway.send_notification(token_hex, payload, identifier)
+            for _ in range(100):
+                if len(received) > 1:
+                    break
+                await asyncio.sleep(0.01)
+            await gateway.close()
+            server.close()
+
+        asyncio.run(run())
+        self.assertEqual(responses, [{'status': 8, 'identifier': 1}])
+        expected = b''.join(
+            GatewayConnection()._get_enhanced_notification(token_hex, payload, i, 0)
+            for i in (2, 3))
+        self.assertEqual(b''.join(received[1:]), expected)
+
+    def testAsyncGatewayResendOrder(self):
+        token_hex = mock_tokens[0]
+        payload = Payload(alert="Hello World!")
+        message_length = len(GatewayConnection()._get_enhanced_notification(
+            token_hex, payload, 0, 0))
+        connections = []
+
+        async def handle(reader, writer):
+            connections.append(b'')
+            index = len(connections) - 1
+            chunk = await reader.read(4096)
+            while chunk:
+                connections[index] += chunk
+                if index == 0:
+                    writer.write(pack(ERROR_RESPONSE_FORMAT, 8, 8, 1))
+                    await writer.drain()
+                    break
+                chunk = await reader.read(4096)
+            writer.close()
+
+        def identifiers(data):
+            return [unpack('>I', data[offset + 1:offset + 5])[0]
+                    for offset in range(0, len(data), message_length)]
+
+        async def run():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            gateway = AsyncGatewayConnection(use_sandbox=True)
+            gateway.server, gateway.port = server.sockets[0].getsockname()[:2]
+            gateway._get_ssl_context = lambda: None
+            async def wait_closed(writer): # like a TLS close, it takes a while
+                await asyncio.sleep(0.01)
+                await AsyncGatewayConnection._wait_closed(writer)
+            gateway._wait_closed = wait_closed
+            # keep sending while the error-response for 1 is handled
+            for identifier in range(1, 101):
+                await gateway.send_notification(token_hex, payload, identifier)
+                await asyncio.sleep(0)
+            for _ in range(100):
+                if len(connections) > 1 and len(connections[1]) >= 99 * message_length:
+                    break
+                await asyncio.sleep(0.01)
+            await gateway.close()
+            server.close()
+
+        asyncio.run(run())
+        # everything after 1 is on the second connection once, in order
+        self.assertEqual(len(connections), 2)
+        self.assertEqual(identifiers(connections[1]), list(range(2, 101)))
+
+    def testAsyncGatewayFrameCopy(self):
+        class Writer(object):
+            def __init__(self):
+                self.data = []
+                self.closed = self.waited = False
+
+            def write(self, data):
+                self.data.append(data)
+
+            async def drain(self):
+                pass
+
+            def close(self):
+                self.closed = True
+
+            async def wait_closed(self):
+                self.waited = True
+
+        async def run():
+            gateway = AsyncGatewayConnection(use_sandbox=True)
+            writer = gateway._writer = Writer()
+            gateway.connection_alive = True
+            frame = Frame()
+            frame.add_item(mock_tokens[0], Payload(alert="Hello World!"), 1, 0, 10)
+            await gateway.send_notification_multiple(frame)
+            # the written data does not change with the frame
+            self.assertEqual(type(writer.data[0]), bytes)
+            frame.add_item(mock_tokens[1], Payload(alert="Hello World!"), 2, 0, 10)
+            await gateway.close()
+            self.assertTrue(writer.closed and writer.waited)
+
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()